@@ -0,0 +1,102 @@
+import argparse
+import json
+import random
+import string
+import time
+import tracemalloc
+from spotifai import Track
+
+"""
+Compares the slotted Track against the old plain class it replaced: how fast pages of API json become tracks, how much memory the
+tracks hold on to once the json is gone, and how fast they serialize for tool outputs.
+Run with e.g. `python bench_containers.py --sizes 1000 10000 50000`.
+"""
+
+"""Track as it was before slots, kept here to compare against."""
+class PlainTrack:
+    def __init__ (self, data, db_id=None, added_at=None):
+        self.name = data['name']
+        self.id = data['id']
+        self.uri = data['uri']
+        self.url = data['external_urls']['spotify']
+        self.db_id = db_id
+        self.added_at = added_at
+        self.features = None
+        self.artist = {"name": data['artists'][0]['name'], "uri": data['artists'][0]['uri']}
+        self.album = {"name": data['album']['name'], "uri": data['album']['uri']}
+
+    def to_json(self):
+        return self.__dict__
+
+    @classmethod
+    def from_page(cls, items):
+        return [cls(item['track'], added_at=item['added_at']) for item in items if item is not None and item['track'] is not None]
+
+def random_id(rng):
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+"""Saved track items shaped like the API's, with a few hundred artists and albums shared between them like a real library."""
+def synthetic_items(n, rng):
+    artists = []
+    for i in range(max(n // 20, 1)):
+        artist_id = random_id(rng)
+        artists.append({"id": artist_id, "name": f"Artist {i}", "uri": "spotify:artist:" + artist_id,
+                        "external_urls": {"spotify": "https://open.spotify.com/artist/" + artist_id}})
+    albums = []
+    for i in range(max(n // 10, 1)):
+        album_id = random_id(rng)
+        albums.append({"id": album_id, "name": f"Album {i}", "uri": "spotify:album:" + album_id, "release_date": "2001-01-01",
+                       "external_urls": {"spotify": "https://open.spotify.com/album/" + album_id}, "artists": [rng.choice(artists)]})
+    items = []
+    for i in range(n):
+        track_id = random_id(rng)
+        album = rng.choice(albums)
+        items.append({"added_at": "2024-01-01T00:00:00Z", "track": {
+            "id": track_id,
+            "name": f"Track {i}",
+            "uri": "spotify:track:" + track_id,
+            "external_urls": {"spotify": "https://open.spotify.com/track/" + track_id},
+            "artists": album['artists'],
+            "album": album,
+            "duration_ms": 200000,
+            "popularity": 50,
+        }})
+    return items
+
+def build(cls, items):
+    start = time.perf_counter()
+    tracks = []
+    for i in range(0, len(items), 50):
+        tracks.extend(cls.from_page(items[i:i + 50]))
+    return tracks, time.perf_counter() - start
+
+"""Bytes the tracks keep allocated, not counting the json they were built from."""
+def retained(cls, items):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracks, _ = build(cls, items)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(tracks)
+
+def serialize(tracks):
+    start = time.perf_counter()
+    json.dumps([track.to_json() for track in tracks])
+    return time.perf_counter() - start
+
+def run(n, rng):
+    items = synthetic_items(n, rng)
+    for name, cls in (("plain", PlainTrack), ("slotted", Track)):
+        tracks, build_time = build(cls, items)
+        print(f"{n:>9} {name:>8} {n / build_time:>12,.0f}/s {retained(cls, items):>10.0f}B {n / serialize(tracks):>12,.0f}/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the track containers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'tracks':>9} {'class':>8} {'build':>14} {'per track':>11} {'to json':>14}")
+    for n in args.sizes:
+        run(n, rng)
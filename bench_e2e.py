@@ -0,0 +1,144 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import mocks
+import spotifai
+import wikicache
+import embeds
+import metrics
+
+"""
+End to end benchmark of the app against the local mocks in mocks.py, with made up but realistic latencies for each upstream.
+Drives download_user_library, get_similar, find_recommendations, research and handle_prompt (with scripted tool-calling runs) and prints, per scenario,
+the wall time and the calls and simulated time spent at each endpoint, then what the app's own metrics saw over the whole run. Nothing touches the network or the real data folder.
+Run with e.g. `python bench_e2e.py --library-size 2000 --latency spotify=0.05 openai=0.4 openai.token=0.002`.
+"""
+
+# seconds per call, by endpoint or by whole upstream. openai.token is per streamed token.
+DEFAULT_LATENCY = {
+    "spotify": 0.05,
+    "openai": 0.4,
+    "openai.token": 0.002,
+    "wikipedia": 0.15,
+    "oembed": 0.1,
+}
+
+def parse_latency(values):
+    latency = dict(DEFAULT_LATENCY)
+    for value in values:
+        name, seconds = value.split("=")
+        latency[name] = float(seconds)
+    return latency
+
+"""Run func, then print how long it took and what it cost at each endpoint, most expensive first.
+Endpoint times are summed over calls, so with calls in parallel they can add up to more than the wall time."""
+def measure(name, log, func):
+    log.reset()
+    start = time.perf_counter()
+    result = func()
+    wall = time.perf_counter() - start
+    stats = log.stats()
+    print(f"\n{name}: {wall:.3f}s, {sum(count for count, _ in stats.values())} calls")
+    for endpoint, (count, seconds) in sorted(stats.items(), key=lambda entry: -entry[1][1]):
+        print(f"    {endpoint:<36} {count:>6} calls {seconds:>9.3f}s")
+    return result
+
+"""Send msg with the assistant scripted to take steps, and report how long until the first and last response."""
+def prompt(sai, openai, log, name, msg, steps):
+    openai.add_script(steps)
+    start = time.perf_counter()
+    first = []
+    on_response = lambda response: first or first.append(time.perf_counter() - start)
+    responses = measure(name, log, lambda: sai.handle_prompt(msg, on_response))
+    print(f"    first response after {first[0] if first else float('nan'):.3f}s, {len(responses)} responses")
+
+"""The app's metrics: latency percentiles per span, then token counts and cache hit rates."""
+def print_metrics(summary):
+    print(f"\n{'span':<36} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, span in sorted(summary['spans'].items()):
+        print(f"{name:<36} {span['count']:>6} {span['errors']:>6} {span['p50_ms']:>9.1f} {span['p95_ms']:>9.1f} {span['p99_ms']:>9.1f}")
+    for name, value in sorted(summary['counters'].items()):
+        if name.startswith("tokens."):
+            print(f"{name:<36} {value:>6}")
+    for name, stats in sorted(summary['caches'].items()):
+        hit_rate = "-" if stats['hit_rate'] is None else f"{stats['hit_rate']:.0%}"
+        print(f"cache {name:<30} {stats['hits']:>6} hits {stats['misses']:>6} misses {hit_rate:>5}")
+
+def run(args):
+    log = mocks.CallLog(parse_latency(args.latency))
+    spotify = mocks.FakeSpotify(log, args.library_size, seed=args.seed)
+    openai = mocks.FakeOpenAI(log)
+    saved_ids = set(item['track']['id'] for item in spotify.library)
+    library = [item['track'] for item in spotify.library]
+    foreign = [track for track in spotify.catalog if track['id'] not in saved_ids][:args.queries]
+
+    # the app reads and writes data/ relative to where it runs, so run it somewhere disposable. Importing spotifai doesn't
+    # touch data/, its caches are made on first use, and the benchmark swaps in its own before then.
+    workdir = tempfile.mkdtemp(prefix="spotifai-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spotifai.wiki_pages = wikicache.WikiCache("Spotifai benchmark", path="data/wiki_cache.sqlite")
+        spotifai.wiki_pages.session = mocks.FakeWikipedia.from_catalog(log, spotify, seed=args.seed)
+        spotifai.embed_cache = embeds.EmbedCache("data/embed_cache.sqlite", local=args.local_embeds)
+        spotifai.embed_cache.session = mocks.FakeOEmbed(log)
+        # traced like login.login does it
+        sai = measure("startup", log, lambda: spotifai.Spotifai(metrics.Traced(spotify, "spotify"), client=openai))
+
+        measure("download_user_library, saved tracks only", log, lambda: sai.download_user_library(progress=None, sources=["saved"]))
+        measure("download_user_library, every source", log, lambda: sai.download_user_library(progress=None))
+        measure("sync_user_library, nothing changed", log, lambda: sai.sync_user_library(progress=None))
+
+        seeds = library[:args.queries]
+        measure(f"get_similar, {len(seeds)} library seeds", log, lambda: [sai.get_similar(track['id']) for track in seeds])
+        measure(f"get_similar, {len(seeds)} library seeds, other artists only", log, lambda: [sai.get_similar(track['id'], exclude_same_artist=True) for track in seeds])
+        for label in ("cold", "warm"):
+            measure(f"get_similar, {len(foreign)} seeds outside the library ({label})", log, lambda: [sai.get_similar(track['id']) for track in foreign])
+        measure("get_similar by feature profile", log, lambda: sai.get_similar(profile={"energy": 0.9, "danceability": 0.8, "tempo": 128}))
+
+        seed_ids = [track['id'] for track in library[:3]]
+        measure("recommendations from the whole library", log, lambda: sai.find_recommendations(n=10))
+        measure("recommendations from 3 seed tracks", log, lambda: sai.find_recommendations(seed_ids, n=10))
+        measure("recommendations from a seed artist", log, lambda: sai.find_recommendations(seed_artists=[library[0]['artists'][0]['id']], n=10))
+        measure("recommendations from Spotify", log, lambda: sai.find_recommendations(seed_ids, n=10, source="remote"))
+        measure("recommendations from Spotify and the library", log, lambda: sai.find_recommendations(seed_ids, n=10, source="both"))
+
+        artist = spotify.artists[1]['name']
+        for label in ("cold", "warm"):
+            measure(f"research artist with a question ({label})", log, lambda: sai.research("artist", artist, "What is their style?"))
+            measure(f"research artist summary ({label})", log, lambda: sai.research("artist", artist))
+        measure("research track without a page", log, lambda: sai.research("track", library[0]['name']))
+        measure("scour_page", log, lambda: sai.scour_page(artist + " (musician)", "album", "music"))
+
+        prompt(sai, openai, log, "handle_prompt, chat only", "hi, what can you do?",
+               ["I can find music, research artists and play things for you."])
+        prompt(sai, openai, log, "handle_prompt, similar tracks", "find me songs like this one",
+               [[("get_similar", {"id": library[1]['id'], "limit": 5})], "Here you go."])
+        prompt(sai, openai, log, "handle_prompt, research", f"tell me about {artist}",
+               [[("research", {"type": "artist", "object": artist, "query": "Who influenced them?"})], "Done."])
+        prompt(sai, openai, log, "handle_prompt, three tools at once", "find Track 10, Artist 2 and Album 4",
+               [[("find_track", {"query": "Track 10"}), ("find_artist", {"query": "Artist 2"}), ("find_album", {"query": "Album 4"})], "Done."])
+        prompt(sai, openai, log, "handle_prompt, two rounds of tools", "describe what's playing",
+               [[("get_current_track", {})], [("describe_track_features", {"track": spotify.playing['name']})], "Done."])
+        print_metrics(metrics.summary())
+    finally:
+        os.chdir(cwd)
+        # the caches point into workdir, let the app make its own again if it's used after this
+        spotifai.wiki_pages = None
+        spotifai.embed_cache = None
+        if args.keep:
+            print(f"\nLeft the benchmark's data in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the app end to end against local mocks.")
+    parser.add_argument("--library-size", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=20, help="seed tracks per get_similar scenario")
+    parser.add_argument("--latency", nargs="*", default=[], metavar="NAME=SECONDS", help="override a latency, e.g. spotify=0.1 or openai.token=0")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--local-embeds", action="store_true", help="build embeds locally instead of requesting them")
+    parser.add_argument("--keep", action="store_true", help="keep the data the benchmark wrote")
+    run(parser.parse_args())
@@ -0,0 +1,82 @@
+import argparse
+import time
+import numpy as np
+import songdb
+
+"""
+Compares songdb backends on synthetic libraries: build time, query latency (p50/p99) and recall@k of Annoy against exact search.
+Run with e.g. `python bench_songdb.py --sizes 1000 10000 100000 --trees 10 50`.
+"""
+
+"""Make a raw feature matrix that roughly follows the ranges of Spotify's audio features."""
+def synthetic_library(n, rng):
+    columns = {
+        'danceability': rng.beta(5, 3, n),
+        'energy': rng.beta(4, 3, n),
+        'key': rng.integers(-1, 12, n),
+        'loudness': rng.normal(-8, 4, n).clip(-60, 0),
+        'mode': rng.integers(0, 2, n),
+        'speechiness': rng.beta(1, 12, n),
+        'acousticness': rng.beta(1, 3, n),
+        'instrumentalness': rng.beta(0.3, 2, n),
+        'liveness': rng.beta(2, 10, n),
+        'valence': rng.beta(3, 3, n),
+        'tempo': rng.normal(120, 28, n).clip(40, 220),
+        'duration_ms': rng.normal(220000, 60000, n).clip(30000, 900000),
+        'time_signature': rng.choice([3, 4, 5], n, p=[0.08, 0.9, 0.02]),
+    }
+    return np.stack([columns[column] for column in songdb.FEATURE_COLUMNS], axis=1).astype(np.float32)
+
+def build(backend, ids, vectors):
+    start = time.perf_counter()
+    backend.add_items(ids, vectors)
+    backend.build()
+    return time.perf_counter() - start
+
+def query_all(backend, queries, k):
+    latencies = []
+    results = []
+    for db_id in queries:
+        start = time.perf_counter()
+        results.append(backend.get_nns_by_item(int(db_id), k))
+        latencies.append(time.perf_counter() - start)
+    return results, np.array(latencies) * 1000
+
+def recall(results, truth, k):
+    hits = [len(set(result[:k]) & set(expected[:k])) for result, expected in zip(results, truth)]
+    return sum(hits) / (k * len(truth))
+
+def run(n, trees, k, n_queries, rng):
+    raw = synthetic_library(n, rng)
+    vectors = songdb.FeatureSchema().fit(raw).transform(raw)
+    ids = np.arange(n)
+    queries = rng.choice(ids, min(n_queries, n), replace=False)
+
+    rows = []
+    exact = songdb.ExactBackend(vectors.shape[1])
+    build_time = build(exact, ids, vectors)
+    truth, latencies = query_all(exact, queries, k)
+    rows.append(("exact", build_time, latencies, 1.0))
+
+    for n_trees in trees:
+        annoy = songdb.AnnoyBackend(vectors.shape[1], n_trees)
+        build_time = build(annoy, ids, vectors)
+        results, latencies = query_all(annoy, queries, k)
+        rows.append((f"annoy/{n_trees}", build_time, latencies, recall(results, truth, k)))
+
+    for name, build_time, latencies, rec in rows:
+        print(f"{n:>9} {name:>10} {build_time:>9.3f}s {np.percentile(latencies, 50):>9.3f}ms {np.percentile(latencies, 99):>9.3f}ms {rec:>9.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark songdb nearest neighbour backends.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--trees", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'tracks':>9} {'backend':>10} {'build':>10} {'p50':>11} {'p99':>11} {'recall@' + str(args.k):>9}")
+    for n in args.sizes:
+        run(n, args.trees, args.k, args.queries, rng)
@@ -0,0 +1,189 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+from collections import OrderedDict
+
+DAY = 24 * 60 * 60
+
+# sentinel for cache misses, since None is a perfectly good cached value
+MISS = object()
+
+"""In-memory least recently used cache with per-entry expiry."""
+class LRUCache:
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISS
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                return MISS
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl if ttl is not None else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+"""Key/value store in SQLite, values are stored as json. Safe to share between threads.
+If max_bytes is set, the least recently used entries are dropped once the stored values add up to more than that."""
+class DiskCache:
+    def __init__(self, path, max_bytes=None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, size INTEGER DEFAULT 0, accessed REAL DEFAULT 0)")
+        # caches made before size limits existed don't have the last two columns
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(cache)")]
+        if "size" not in columns:
+            self.conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER DEFAULT 0")
+            self.conn.execute("ALTER TABLE cache ADD COLUMN accessed REAL DEFAULT 0")
+        self.conn.commit()
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        if entry is MISS:
+            return MISS
+        return entry[0]
+
+    """(value, expiry time or None) for key, or MISS."""
+    def get_entry(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_bytes is not None:
+                # only worth the write when there's a size limit to evict by
+                self.conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+        if row is None:
+            return MISS
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return MISS
+        return json.loads(value), expires
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        value = json.dumps(value)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (key, value, expires, size, accessed) VALUES (?, ?, ?, ?, ?)", (key, value, expires, len(value), time.time()))
+            if self.max_bytes is not None:
+                self.evict()
+            self.conn.commit()
+
+    """Drop least recently used entries until the cache fits in max_bytes. Called with the lock held."""
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # aim a bit under the limit so we're not evicting on every write
+        target = self.max_bytes * 0.9
+        for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY accessed").fetchall():
+            if total <= target:
+                break
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total -= size
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.conn.commit()
+
+    """Drop everything that has expired."""
+    def purge(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+            self.conn.commit()
+
+"""Memory first, then disk. Disk hits are copied back into memory, expiring when the disk entry does."""
+class TieredCache:
+    def __init__(self, path, max_entries=2048, max_bytes=None):
+        self.memory = LRUCache(max_entries)
+        self.disk = DiskCache(path, max_bytes)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not MISS:
+            return value
+        entry = self.disk.get_entry(key)
+        if entry is MISS:
+            return MISS
+        value, expires = entry
+        if expires is None:
+            self.memory.set(key, value)
+        elif expires > time.time():
+            self.memory.set(key, value, expires - time.time())
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl)
+        self.disk.set(key, value, ttl)
+
+# how long each Spotify endpoint's results are kept, in seconds. Anything not listed (playback state, the user's library,
+# recommendations, anything that changes state) is never cached.
+SPOTIFY_TTLS = {
+    'track': 30 * DAY,
+    'tracks': 30 * DAY,
+    'album': 30 * DAY,
+    'album_tracks': 30 * DAY,
+    'audio_features': 30 * DAY,
+    'artist': 7 * DAY,
+    'artist_top_tracks': DAY,
+    'search': DAY,
+}
+
+"""Wraps a spotipy.Spotify client, caching reads of the endpoints in SPOTIFY_TTLS. Everything else goes straight through.
+Cached results are shared, so callers shouldn't modify them."""
+class CachedSpotify:
+    def __init__(self, sp, path="data/spotify_cache.sqlite", ttls=SPOTIFY_TTLS, max_entries=2048):
+        self.sp = sp
+        self.cache = TieredCache(path, max_entries)
+        self.ttls = ttls
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.sp, name)
+        if name not in self.ttls or not callable(attr):
+            return attr
+        ttl = self.ttls[name]
+
+        def cached(*args, **kwargs):
+            key = name + ":" + json.dumps([args, kwargs], sort_keys=True)
+            value = self.cache.get(key)
+            if value is not MISS:
+                self.count(self.hits, name)
+                metrics.count("cache.spotify.hits")
+                return value
+            self.count(self.misses, name)
+            metrics.count("cache.spotify.misses")
+            value = attr(*args, **kwargs)
+            self.cache.set(key, value, ttl)
+            return value
+        return cached
+
+    def count(self, counter, name):
+        with self.lock:
+            counter[name] = counter.get(name, 0) + 1
+
+    """Hit and miss counts per endpoint."""
+    def stats(self):
+        with self.lock:
+            names = set(self.hits) | set(self.misses)
+            return {name: {"hits": self.hits.get(name, 0), "misses": self.misses.get(name, 0)} for name in names}
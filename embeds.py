@@ -0,0 +1,63 @@
+import html
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+import cache
+import metrics
+
+OEMBED_URL = "https://open.spotify.com/oembed?url="
+
+# heights Spotify's own embeds use, albums and playlists get room for a track list
+HEIGHTS = {"track": 152, "episode": 152}
+DEFAULT_HEIGHT = 352
+
+"""The iframe Spotify's oEmbed endpoint would return for item (anything with a uri and a name), built without asking it."""
+def local_embed(item):
+    kind, item_id = item.uri.split(":")[1:3]
+    title = html.escape(f"Spotify Embed: {item.name}", quote=True)
+    return (f'<iframe style="border-radius: 12px" width="100%" height="{HEIGHTS.get(kind, DEFAULT_HEIGHT)}" title="{title}" frameborder="0" allowfullscreen '
+            f'allow="autoplay; clipboard-write; encrypted-media; fullscreen; picture-in-picture" loading="lazy" '
+            f'src="https://open.spotify.com/embed/{kind}/{item_id}?utm_source=oembed"></iframe>')
+
+"""Spotify embed html, cached in memory and on disk by url. An embed for a url never really changes, so entries don't expire,
+the disk cache just drops the least recently used ones past max_bytes.
+With local set, nothing is requested at all and the iframe is built from the item's id. A failed request falls back to that too."""
+class EmbedCache:
+    def __init__(self, path="data/embed_cache.sqlite", local=False, workers=5, max_bytes=20_000_000):
+        self.local = local
+        self.workers = workers
+        self.session = requests.Session()
+        # keep a connection open per worker, so a turn's embeds don't each pay for a new TLS handshake
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.store = cache.TieredCache(path, max_entries=1024, max_bytes=max_bytes)
+
+    def get(self, item):
+        return self.get_many([item])[0]
+
+    """Embeds for several items, in order. Anything not cached is fetched concurrently, so this takes one round trip."""
+    def get_many(self, items):
+        if self.local:
+            return [local_embed(item) for item in items]
+        embeds = [self.store.get(item.url) for item in items]
+        missing = [item for item, embed in zip(items, embeds) if embed is cache.MISS]
+        metrics.count("cache.embeds.hits", len(items) - len(missing))
+        metrics.count("cache.embeds.misses", len(missing))
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), self.workers)) as pool:
+                fetched = dict(zip((item.url for item in missing), pool.map(self.fetch, missing)))
+            embeds = [fetched[item.url] if embed is cache.MISS else embed for item, embed in zip(items, embeds)]
+        return embeds
+
+    def fetch(self, item):
+        try:
+            with metrics.span("oembed"):
+                response = self.session.get(OEMBED_URL + quote(item.url, safe=''), timeout=10)
+                response.raise_for_status()
+                embed = response.json()['html']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Couldn't get the embed for {item.url}: {e!r}")
+            # not cached, so the real one is tried again next time
+            return local_embed(item)
+        self.store.set(item.url, embed)
+        return embed
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import cache
+import library
+import metrics
+
+DAY = 24 * 60 * 60
+
+"""Audio features by track id. A track's features never change, so once known they're kept for good.
+Library tracks are read from the library store, anything else from a SQLite cache and only then from Spotify.
+Misses aren't fetched one by one: ids asked for within batch_window seconds of each other, from any thread, are collected and
+fetched together in audio_features calls of up to 100 ids. Tracks Spotify has no features for are remembered for a day."""
+class FeatureStore:
+    def __init__(self, sp, path="data/features.sqlite", library_store=None, batch_window=0.01, workers=4, gate=None):
+        self.sp = sp
+        self.library_store = library_store
+        self.store = cache.TieredCache(path, max_entries=4096)
+        self.batch_window = batch_window
+        self.gate = gate or library.RateGate()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # ids waiting for the next batch, and the futures everyone asking for an id waits on
+        self.queue = []
+        self.in_flight = {}
+        self.scheduled = False
+
+    def get(self, track_id):
+        return self.get_many([track_id])[track_id]
+
+    """Features for several tracks, as {id: features or None}. Ids can be uris too, the result is keyed by what was asked for."""
+    def get_many(self, track_ids):
+        found = {}
+        waiting = {}
+        for requested in track_ids:
+            track_id = requested.split(":")[-1]
+            features = self.local(track_id)
+            if features is cache.MISS:
+                waiting[requested] = self.request(track_id)
+            else:
+                found[requested] = features
+        metrics.count("cache.features.hits", len(found))
+        metrics.count("cache.features.misses", len(waiting))
+        for requested, future in waiting.items():
+            found[requested] = future.result()
+        return found
+
+    """Attach features to every track that doesn't have them yet, in as few calls as possible."""
+    def enrich(self, tracks):
+        missing = [track for track in tracks if track.features is None]
+        features = self.get_many([track.id for track in missing])
+        for track in missing:
+            track.set_features(features[track.id])
+        return tracks
+
+    """Features without asking Spotify, or cache.MISS."""
+    def local(self, track_id):
+        if self.library_store is not None:
+            row = self.library_store.row_of_id(track_id)
+            if row is not None:
+                features = self.library_store.features_of(row)
+                if features is not None:
+                    return features
+        return self.store.get(track_id)
+
+    """A future for track_id's features, joining a fetch that's already on its way if there is one."""
+    def request(self, track_id):
+        with self.lock:
+            future = self.in_flight.get(track_id)
+            if future is None:
+                future = Future()
+                self.in_flight[track_id] = future
+                self.queue.append(track_id)
+                if not self.scheduled:
+                    self.scheduled = True
+                    self.pool.submit(self.flush)
+            return future
+
+    """Wait out the batch window so concurrent callers can add their ids, then fetch everything queued."""
+    def flush(self):
+        time.sleep(self.batch_window)
+        with self.lock:
+            track_ids = self.queue
+            self.queue = []
+            self.scheduled = False
+        for i in range(0, len(track_ids), library.FEATURE_BATCH_SIZE):
+            self.pool.submit(self.fetch, track_ids[i:i + library.FEATURE_BATCH_SIZE])
+
+    def fetch(self, track_ids):
+        try:
+            results = self.gate.call(self.sp.audio_features, track_ids)
+        except Exception as e:
+            with self.lock:
+                futures = [self.in_flight.pop(track_id) for track_id in track_ids]
+            for future in futures:
+                future.set_exception(e)
+            return
+        results = results or []
+        for track_id, features in zip(track_ids, results):
+            self.store.set(track_id, features, DAY if features is None else None)
+            with self.lock:
+                future = self.in_flight.pop(track_id)
+            future.set_result(features)
+        # ids Spotify didn't answer for at all get None but aren't cached, so they're asked for again next time.
+        # Left unresolved, everyone waiting on them would wait forever.
+        if len(results) < len(track_ids):
+            with self.lock:
+                futures = [self.in_flight.pop(track_id) for track_id in track_ids[len(results):]]
+            for future in futures:
+                future.set_result(None)
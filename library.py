@@ -0,0 +1,231 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from spotipy.exceptions import SpotifyException
+
+PAGE_SIZE = 50
+FEATURE_BATCH_SIZE = 100
+
+"""Shared rate limit state for the ingestion workers. When any worker gets a 429, every worker waits out the Retry-After window before its next call."""
+class RateGate:
+    def __init__(self, base_delay=1.0, max_delay=60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = base_delay
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            pause = self.resume_at - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            # honor Retry-After if Spotify sent one, otherwise back off exponentially
+            if retry_after is not None:
+                pause = float(retry_after)
+            else:
+                pause = self.delay
+                self.delay = min(self.delay * 2, self.max_delay)
+            self.resume_at = max(self.resume_at, time.monotonic() + pause)
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.base_delay
+
+    """Call a spotipy method through the gate, retrying on 429s."""
+    def call(self, func, *args, max_retries=6, **kwargs):
+        for attempt in range(max_retries + 1):
+            self.wait()
+            try:
+                result = func(*args, **kwargs)
+            except SpotifyException as e:
+                if e.http_status != 429 or attempt == max_retries:
+                    raise
+                headers = e.headers or {}
+                self.throttled(headers.get('Retry-After', headers.get('retry-after')))
+                continue
+            self.succeeded()
+            return result
+
+"""Default progress callback, prints a line per completed page or feature batch. total is None when it isn't known up front."""
+def print_progress(stage, done, total):
+    print(f"{stage}: {done}/{total}" if total is not None else f"{stage}: {done}")
+
+"""Fetch audio features for up to 100 tracks in one call and attach them to the tracks. Returns the batch."""
+def fetch_feature_batch(sp, batch, gate):
+    features = gate.call(sp.audio_features, [track.id for track in batch])
+    for track, feature in zip(batch, features):
+        track.set_features(feature)
+    return batch
+
+"""Fetch audio features for any number of tracks, batched and in parallel."""
+def fetch_features(sp, tracks, workers=8, gate=None):
+    gate = gate or RateGate()
+    batches = [tracks[i:i + FEATURE_BATCH_SIZE] for i in range(0, len(tracks), FEATURE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda batch: fetch_feature_batch(sp, batch, gate), batches))
+    return tracks
+
+# every place the user's taste can be read from. Earlier sources win when a track is in several.
+SOURCES = ('saved', 'playlists', 'top', 'recent')
+PLAYLIST_PAGE_SIZE = 100
+
+"""Call fetch(arg) for each of args on the pool and yield the results in order, with at most window calls in flight,
+so pages that arrive early don't pile up in memory."""
+def fetch_in_order(pool, fetch, args, window):
+    in_flight = deque()
+    for arg in args:
+        in_flight.append(pool.submit(fetch, arg))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+"""Each source yields pages of (track json, added_at) pairs."""
+def saved_pages(ingest, pool):
+    sp, gate = ingest.sp, ingest.gate
+    # the first page tells us how many tracks there are, so we don't ask for pages past the end
+    first = gate.call(sp.current_user_saved_tracks, limit=PAGE_SIZE, offset=0)
+    ingest.saved_total = first['total']
+    yield [(item['track'], item['added_at']) for item in first['items']]
+    fetch = lambda offset: gate.call(sp.current_user_saved_tracks, limit=PAGE_SIZE, offset=offset)
+    for page in fetch_in_order(pool, fetch, range(PAGE_SIZE, first['total'], PAGE_SIZE), ingest.workers * 2):
+        yield [(item['track'], item['added_at']) for item in page['items']]
+
+"""Tracks of every playlist the user owns or follows. All the playlists' pages are fetched as one stream, so lots of small playlists don't
+cost a round trip each in turn."""
+def playlist_pages(ingest, pool):
+    sp, gate = ingest.sp, ingest.gate
+    playlists = []
+    offset = 0
+    while True:
+        page = gate.call(sp.current_user_playlists, limit=PAGE_SIZE, offset=offset)
+        playlists.extend(page['items'])
+        offset += PAGE_SIZE
+        if offset >= page['total'] or len(page['items']) == 0:
+            break
+    pages = [(playlist['id'], offset) for playlist in playlists if playlist is not None for offset in range(0, playlist['tracks']['total'], PLAYLIST_PAGE_SIZE)]
+    fetch = lambda page: gate.call(sp.playlist_items, page[0], limit=PLAYLIST_PAGE_SIZE, offset=page[1], additional_types=('track',))
+    for page in fetch_in_order(pool, fetch, pages, ingest.workers * 2):
+        yield [(item['track'], item.get('added_at')) for item in page['items']]
+
+def top_pages(ingest, pool):
+    fetch = lambda time_range: ingest.gate.call(ingest.sp.current_user_top_tracks, limit=PAGE_SIZE, time_range=time_range)
+    for page in fetch_in_order(pool, fetch, ['short_term', 'medium_term', 'long_term'], 3):
+        yield [(track, None) for track in page['items']]
+
+def recent_pages(ingest, pool):
+    page = ingest.gate.call(ingest.sp.current_user_recently_played, limit=PAGE_SIZE)
+    yield [(item['track'], None) for item in page['items']]
+
+SOURCE_PAGES = {
+    'saved': saved_pages,
+    'playlists': playlist_pages,
+    'top': top_pages,
+    'recent': recent_pages,
+}
+
+"""Download the user's tracks from sources (see SOURCES), de-duplicated by id, with their audio features.
+Iterate over it to get the tracks in batches of up to 100 as their features arrive, so the caller can build the index as it goes
+and raw API pages never pile up. Pages and feature batches are fetched concurrently. make_track(data, added_at, source) turns
+track json into a Track. After iterating, counts has the number of tracks taken from each source and saved_total the raw saved track count."""
+class Ingest:
+    def __init__(self, sp, make_track, sources=SOURCES, workers=8, progress=print_progress, gate=None):
+        unknown = [source for source in sources if source not in SOURCE_PAGES]
+        if unknown:
+            raise ValueError(f"Unknown library sources {unknown}")
+        self.sp = sp
+        self.make_track = make_track
+        self.sources = list(sources)
+        self.workers = workers
+        self.progress = progress or (lambda stage, done, total: None)
+        self.gate = gate or RateGate()
+        self.counts = {source: 0 for source in self.sources}
+        self.saved_total = 0
+
+    def __iter__(self):
+        seen = set()
+        pending = []
+        in_flight = deque()
+        features_done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for source in self.sources:
+                for page in SOURCE_PAGES[source](self, pool):
+                    for data, added_at in page:
+                        # removed, local and podcast items have no id or no features
+                        if data is None or data.get('id') is None or data.get('type', 'track') != 'track' or data['id'] in seen:
+                            continue
+                        seen.add(data['id'])
+                        pending.append(self.make_track(data, added_at, source))
+                        self.counts[source] += 1
+                        if len(pending) == FEATURE_BATCH_SIZE:
+                            in_flight.append(pool.submit(fetch_feature_batch, self.sp, pending, self.gate))
+                            pending = []
+                    self.progress(source, self.counts[source], None)
+                    # hand over whatever batches are ready without waiting on the rest
+                    while in_flight and in_flight[0].done():
+                        features_done += len(in_flight[0].result())
+                        yield in_flight.popleft().result()
+                    self.progress("features", features_done, len(seen))
+            if pending:
+                in_flight.append(pool.submit(fetch_feature_batch, self.sp, pending, self.gate))
+            while in_flight:
+                features_done += len(in_flight[0].result())
+                yield in_flight.popleft().result()
+                self.progress("features", features_done, len(seen))
+
+"""Fetch every saved track item after the first page, concurrently. Returns the items in library order, without features."""
+def fetch_saved_items(sp, first, workers=8, gate=None):
+    gate = gate or RateGate()
+    offsets = range(PAGE_SIZE, first['total'], PAGE_SIZE)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pages = list(pool.map(lambda offset: gate.call(sp.current_user_saved_tracks, limit=PAGE_SIZE, offset=offset), offsets))
+    items = list(first['items'])
+    for page in pages:
+        items.extend(page['items'])
+    return [item for item in items if item['track'] is not None and item['track']['id'] is not None]
+
+"""Work out what changed in the user's saved tracks since the last sync.
+Saved tracks come back newest first, so pages are read until the first already known track. If the totals then don't add up
+(tracks were removed, or an old track was re-saved) the full list of ids is fetched, still without any feature calls.
+Returns (new_tracks, removed_ids, total), with features fetched for the new tracks only."""
+def sync_saved_tracks(sp, known_ids, last_total, make_track, workers=8, progress=print_progress, gate=None):
+    gate = gate or RateGate()
+    progress = progress or (lambda stage, done, total: None)
+
+    new_items = []
+    found_known = False
+    first = None
+    offset = 0
+    while not found_known:
+        page = gate.call(sp.current_user_saved_tracks, limit=PAGE_SIZE, offset=offset)
+        first = first or page
+        for item in page['items']:
+            if item['track'] is None or item['track']['id'] is None:
+                continue
+            if item['track']['id'] in known_ids:
+                found_known = True
+                break
+            new_items.append(item)
+        offset += PAGE_SIZE
+        progress("new tracks", len(new_items), first['total'])
+        if offset >= page['total'] or len(page['items']) == 0:
+            break
+
+    removed_ids = set()
+    # last_total is the raw count from the previous sync, local files included, so it can be compared to 'total' directly
+    if first['total'] != last_total + len(new_items):
+        items = fetch_saved_items(sp, first, workers, gate)
+        current_ids = set(item['track']['id'] for item in items)
+        removed_ids = set(known_ids) - current_ids
+        new_items = [item for item in items if item['track']['id'] not in known_ids]
+        progress("full scan", len(items), first['total'])
+
+    new_tracks = [make_track(item, None) for item in new_items]
+    fetch_features(sp, new_tracks, workers, gate)
+    progress("features", len(new_tracks), len(new_tracks))
+    return new_tracks, removed_ids, first['total']
@@ -0,0 +1,257 @@
+import json
+import os
+import shutil
+from collections.abc import MutableMapping
+import numpy as np
+import songdb
+
+"""
+Compact on-disk store for the user's library, loaded with memory maps so startup doesn't parse anything and only touched pages are read.
+A store is a directory of flat arrays, one row per track:
+    ids.npy             22-byte base62 Spotify ids
+    db_ids.npy          songdb id of each row, -1 if the track isn't indexed
+    features.npy        float32 audio features in songdb.FEATURE_COLUMNS order, NaN for tracks without features
+    strings.npy         per row, indexes into the string table for each of STRING_FIELDS, -1 for none
+    string_offsets.npy  start of each interned string in string_data.bin, plus the end of the last one
+    string_data.bin     every distinct string once, utf-8
+    sorted_ids.npy      ids.npy sorted, for binary search by Spotify id
+    sorted_rows.npy     the row of each sorted id
+    db_rows.npy         the row of each songdb id, -1 for gaps
+    meta.json           row count, the raw saved track total from the last sync and the string fields stored
+Run this file to convert the old json library files.
+"""
+
+ID_LENGTH = 22
+STRING_FIELDS = ['name', 'artist_name', 'artist_uri', 'album_name', 'album_uri', 'added_at', 'source']
+
+class LibraryStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.count = meta['count']
+        self.total = meta['total']
+        self.feature_columns = meta['feature_columns']
+        # stores written before tracks had a source don't have that column
+        self.string_fields = meta.get('string_fields', STRING_FIELDS[:6])
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode='r')
+        self.ids = load("ids.npy")
+        self.db_ids = load("db_ids.npy")
+        self.features = load("features.npy")
+        self.strings = load("strings.npy")
+        self.string_offsets = load("string_offsets.npy")
+        self.sorted_ids = load("sorted_ids.npy")
+        self.sorted_rows = load("sorted_rows.npy")
+        self.db_rows = load("db_rows.npy")
+        # an empty file can't be memory mapped
+        data_path = os.path.join(path, "string_data.bin")
+        self.string_data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) > 0 else np.zeros(0, dtype=np.uint8)
+        # string -> index in the string table, only built if something looks rows up by value
+        self.string_index = None
+
+    def __len__(self):
+        return self.count
+
+    """Row of a Spotify track id, or None."""
+    def row_of_id(self, track_id):
+        key = track_id.encode()
+        i = int(np.searchsorted(self.sorted_ids, key))
+        if i < self.count and self.sorted_ids[i] == key:
+            return int(self.sorted_rows[i])
+        return None
+
+    """Row of a songdb id, or None."""
+    def row_of_db_id(self, db_id):
+        if db_id is None or db_id < 0 or db_id >= len(self.db_rows):
+            return None
+        row = int(self.db_rows[db_id])
+        return row if row >= 0 else None
+
+    def string(self, i):
+        if i < 0:
+            return None
+        return bytes(self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]]).decode()
+
+    """Rows whose field (one of STRING_FIELDS) is value, e.g. every track by an artist uri."""
+    def rows_where(self, field, value):
+        if self.string_index is None:
+            self.string_index = {self.string(i): i for i in range(len(self.string_offsets) - 1)}
+        i = self.string_index.get(value)
+        if i is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.nonzero(np.asarray(self.strings[:, self.string_fields.index(field)]) == i)[0]
+
+    """The audio features stored for row, or None if it has none."""
+    def features_of(self, row):
+        values = self.features[row]
+        if np.isnan(values).any():
+            return None
+        return {column: value for column, value in zip(self.feature_columns, values.tolist())}
+
+    """Everything stored about the track in row, in the same shape as Track.to_json()."""
+    def track_data(self, row):
+        track_id = self.ids[row].decode()
+        strings = {field: self.string(int(i)) for field, i in zip(self.string_fields, self.strings[row])}
+        db_id = int(self.db_ids[row])
+        features = self.features_of(row)
+        return {
+            "name": strings['name'],
+            "id": track_id,
+            "uri": "spotify:track:" + track_id,
+            "url": "https://open.spotify.com/track/" + track_id,
+            "db_id": db_id if db_id >= 0 else None,
+            "added_at": strings['added_at'],
+            "source": strings.get('source'),
+            "features": features,
+            "artist": {"name": strings['artist_name'], "uri": strings['artist_uri']},
+            "album": {"name": strings['album_name'], "uri": strings['album_uri']},
+        }
+
+"""Write tracks (anything with Track's attributes) to a store at path. The new store is built next to the old one and swapped in,
+so anything that still has the old files mapped keeps working. features is the tracks' raw feature matrix (see songdb.feature_matrix),
+for when it's already been built and the tracks no longer hold their own."""
+def write(path, tracks, total, features=None):
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    n = len(tracks)
+    columns = songdb.FEATURE_COLUMNS
+
+    ids = np.array([track.id.encode() for track in tracks], dtype=f"S{ID_LENGTH}")
+    db_ids = np.array([track.db_id if track.db_id is not None else -1 for track in tracks], dtype=np.int32)
+    if features is None:
+        features = songdb.feature_matrix([track.features for track in tracks])
+
+    # intern strings, so an artist or album shared by many tracks is stored once
+    interned = {}
+    strings = np.full((n, len(STRING_FIELDS)), -1, dtype=np.int32)
+    for row, track in enumerate(tracks):
+        values = [track.name, track.artist['name'], track.artist['uri'], track.album['name'], track.album['uri'], getattr(track, 'added_at', None), getattr(track, 'source', None)]
+        for col, value in enumerate(values):
+            if value is not None:
+                strings[row, col] = interned.setdefault(value, len(interned))
+    encoded = [value.encode() for value in interned]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=string_offsets[1:])
+
+    order = np.argsort(ids, kind='stable')
+    db_rows = np.full(int(db_ids.max()) + 1 if n and db_ids.max() >= 0 else 0, -1, dtype=np.int32)
+    indexed = db_ids >= 0
+    db_rows[db_ids[indexed]] = np.nonzero(indexed)[0]
+
+    save = lambda name, array: np.save(os.path.join(tmp_path, name), array)
+    save("ids.npy", ids)
+    save("db_ids.npy", db_ids)
+    save("features.npy", features)
+    save("strings.npy", strings)
+    save("string_offsets.npy", string_offsets)
+    save("sorted_ids.npy", ids[order])
+    save("sorted_rows.npy", order.astype(np.int32))
+    save("db_rows.npy", db_rows)
+    with open(os.path.join(tmp_path, "string_data.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"count": n, "total": total, "feature_columns": columns, "string_fields": STRING_FIELDS}, f)
+
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+"""Spotify id -> songdb id, read straight from a store. Removing ids (after a sync) only hides them, the store isn't changed."""
+class SpToDbIdMap(MutableMapping):
+    def __init__(self, store):
+        self.store = store
+        self.removed = set()
+
+    def __getitem__(self, track_id):
+        row = self.store.row_of_id(track_id) if track_id not in self.removed else None
+        if row is None or self.store.db_ids[row] < 0:
+            raise KeyError(track_id)
+        return int(self.store.db_ids[row])
+
+    def __setitem__(self, track_id, db_id):
+        raise TypeError("The library store is read only, rebuild it with librarystore.write")
+
+    def __delitem__(self, track_id):
+        self[track_id]
+        self.removed.add(track_id)
+
+    def __iter__(self):
+        for row in np.nonzero(np.asarray(self.store.db_ids) >= 0)[0]:
+            track_id = self.store.ids[row].decode()
+            if track_id not in self.removed:
+                yield track_id
+
+    def __len__(self):
+        return int((np.asarray(self.store.db_ids) >= 0).sum()) - len(self.removed)
+
+"""songdb id -> Spotify id, read straight from a store. Removals work the same as SpToDbIdMap."""
+class DbToSpIdMap(MutableMapping):
+    def __init__(self, store):
+        self.store = store
+        self.removed = set()
+
+    def __getitem__(self, db_id):
+        row = self.store.row_of_db_id(db_id) if db_id not in self.removed else None
+        if row is None:
+            raise KeyError(db_id)
+        return self.store.ids[row].decode()
+
+    def __setitem__(self, db_id, track_id):
+        raise TypeError("The library store is read only, rebuild it with librarystore.write")
+
+    def __delitem__(self, db_id):
+        self[db_id]
+        self.removed.add(db_id)
+
+    def __iter__(self):
+        for db_id, row in enumerate(self.store.db_rows):
+            if row >= 0 and db_id not in self.removed:
+                yield db_id
+
+    def __len__(self):
+        return int((np.asarray(self.store.db_rows) >= 0).sum()) - len(self.removed)
+
+"""songdb id -> Track, built from the store when asked for, so only tracks that are actually used become Python objects.
+make_track turns a stored track dict into a Track."""
+class TrackStore:
+    def __init__(self, store, make_track):
+        self.store = store
+        self.make_track = make_track
+
+    def get(self, db_id, default=None):
+        row = self.store.row_of_db_id(db_id)
+        if row is None:
+            return default
+        return self.make_track(self.store.track_data(row))
+
+    def __getitem__(self, db_id):
+        track = self.get(db_id)
+        if track is None:
+            raise KeyError(db_id)
+        return track
+
+    def __contains__(self, db_id):
+        return self.store.row_of_db_id(db_id) is not None
+
+"""Convert data/user_library.json and data/library_state.json into a store at data/library."""
+def convert_json(data_dir="data"):
+    with open(os.path.join(data_dir, "user_library.json")) as f:
+        tracks = [JsonTrack(data) for data in json.load(f)]
+    total = len(tracks)
+    if os.path.exists(os.path.join(data_dir, "library_state.json")):
+        with open(os.path.join(data_dir, "library_state.json")) as f:
+            total = json.load(f)['total']
+    write(os.path.join(data_dir, "library"), tracks, total)
+    return len(tracks)
+
+"""A track from the old json library (a saved Track.__dict__) with attribute access, for converting without importing spotifai."""
+class JsonTrack:
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+if __name__ == "__main__":
+    print(f"Converted {convert_json()} tracks to data/library.")
@@ -1,5 +1,7 @@
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+import cache
+import metrics
 
 """
 send a post request that looks like this:
@@ -8,9 +10,14 @@ curl -X POST "https://accounts.spotify.com/api/token" \
      -d "grant_type=client_credentials&client_id=your-client-id&client_secret=your-client-secret"
 """
 
-def login(client_id, client_secret):
+"""Log in to Spotify. Unless use_cache is False, reads of stable data (tracks, albums, searches...) are cached in memory and in cache_path.
+Every call that actually reaches Spotify is timed as a 'spotify.<method>' span."""
+def login(client_id, client_secret, use_cache=True, cache_path="data/spotify_cache.sqlite"):
     sp = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=client_id,
                                                client_secret=client_secret,
                                                redirect_uri="http://localhost:8888/callback",
-                                               scope="user-library-read,user-library-modify,user-read-recently-played,user-read-currently-playing,user-modify-playback-state,user-read-playback-state,app-remote-control,playlist-read-private,playlist-modify-private,user-top-read,user-library-modify"))
+                                               scope="user-library-read,user-library-modify,user-read-recently-played,user-read-currently-playing,user-modify-playback-state,user-read-playback-state,app-remote-control,playlist-read-private,playlist-read-collaborative,playlist-modify-private,user-top-read,user-library-modify"))
+    sp = metrics.Traced(sp, "spotify")
+    if use_cache:
+        return cache.CachedSpotify(sp, cache_path)
     return sp
\ No newline at end of file
@@ -1,43 +1,82 @@
 import login
 import dotenv
 import spotifai
+import metrics
 from openai import OpenAI
 from http.server import HTTPServer 
 from flask import Flask, request, render_template
 from flask_socketio import SocketIO
 import json
+from queue import Queue
 import requests
-import wikipediaapi
 
 app = Flask(__name__)
 socketio = SocketIO(app)
 client_id = dotenv.get_key('.env', 'CLIENT_ID')
 client_secret = dotenv.get_key('.env', 'CLIENT_SECRET')
+# set TRACE_LOG in .env to also get every span, tagged with its turn, as a line of json in that file
+trace_log = dotenv.get_key('.env', 'TRACE_LOG')
+if trace_log:
+    metrics.trace_to(trace_log)
 sp = login.login(client_id, client_secret)
 sai = spotifai.Spotifai(sp)
 
 def add(x, y):
     return x + y
 
-def handle_message(msg):
+# each connected socket gets its own conversation and a queue of messages waiting to be handled
+sessions = {}
+
+"""Work through one session's messages in order, in the background so other sessions aren't held up."""
+def session_worker(sid, session, queue):
+    while True:
+        msg = queue.get()
+        if msg is None:
+            break
+        handle_message(sid, session, msg)
+
+def handle_message(sid, session, msg):
     if msg == "exit":
-        exit()
-    responses = sai.handle_prompt(msg)    
-    for response in responses:
-        socketio.emit(response['type'], response['content'])
+        session.reset_conversation()
+        socketio.emit('system', "Conversation cleared.", to=sid)
+        return
+    try:
+        # responses go out as soon as they're produced rather than when the whole turn is done
+        session.handle_prompt(msg, on_response=lambda response: socketio.emit(response['type'], response['content'], to=sid))
+    except Exception as e:
+        print(f"Failed to handle message from {sid}: {e!r}")
+        socketio.emit('system', "Something went wrong handling that message.", to=sid)
 
 @app.route('/')
 def session():
     return render_template('index.html')
 
+"""Counts and p50/p95/p99 latencies per tool and per upstream endpoint, token usage and cache hit rates, since the server started."""
+@app.route('/metrics')
+def metrics_summary():
+    return metrics.summary()
+
 def messageReceived(methods=['GET', 'POST']):
     print('message was received!!!')
 
+@socketio.on('connect')
+def handle_connect():
+    queue = Queue()
+    sessions[request.sid] = queue
+    socketio.start_background_task(session_worker, request.sid, sai.new_session(), queue)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    queue = sessions.pop(request.sid, None)
+    if queue is not None:
+        # let the worker finish what it's doing, then stop
+        queue.put(None)
+
 @socketio.on('user-message')
 def handle_my_custom_event(json_data, methods=['GET', 'POST']):
     print('received message: ' + str(json_data))
-    socketio.emit('message-received', json_data, callback=messageReceived)
-    handle_message(json_data['message'])
+    socketio.emit('message-received', json_data, to=request.sid, callback=messageReceived)
+    sessions[request.sid].put(json_data['message'])
     
 
 commands = {
@@ -55,7 +94,9 @@ commands = {
     "add": add,
     "exit": exit,
     "download_library": sai.download_user_library,
-    "get_similar": sai.get_similar
+    "sync_library": sai.sync_user_library,
+    "get_similar": sai.get_similar,
+    "metrics": metrics.summary
 }
 if __name__ == "__main__":
     choice = input("Web or CLI? (w/c): ")
@@ -0,0 +1,150 @@
+import contextvars
+import itertools
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+"""
+Timing for everything a turn waits on. Each external call (Spotify, OpenAI, Wikipedia, oEmbed) and each tool run is a span;
+spans are aggregated by name into counts, errors and latency percentiles over the most recent samples. Counters keep token usage
+and cache hits and misses. Optionally every span is also written to a JSON-lines trace log, tagged with the turn it belongs to.
+Names are dotted, upstream first: 'spotify.search', 'openai.run', 'tool.get_similar', 'cache.llm.hits'.
+"""
+
+# how many recent durations are kept per span name for percentiles
+SAMPLES = 2048
+
+class Metrics:
+    def __init__(self, samples=SAMPLES):
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.counts = {}
+        self.errors = {}
+        self.counters = {}
+        self.trace_file = None
+        self.turn_ids = itertools.count(1)
+        self.current_turn = contextvars.ContextVar("turn", default=None)
+
+    """Time the block as a span called name. attrs (and anything added to the yielded dict) go into the trace log.
+    A block that raises counts as an error and the exception carries on."""
+    @contextmanager
+    def span(self, name, **attrs):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error, **attrs)
+
+    """Add a span that was timed some other way."""
+    def record(self, name, seconds, error=None, **attrs):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.samples)
+                self.counts[name] = 0
+                self.errors[name] = 0
+            self.durations[name].append(seconds)
+            self.counts[name] += 1
+            if error is not None:
+                self.errors[name] += 1
+        if self.trace_file is not None:
+            self.trace({"time": time.time(), "turn": self.current_turn.get(), "span": name, "ms": round(seconds * 1000, 3), "error": error, **attrs})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    """Count an OpenAI response's token usage as 'tokens.<kind>.prompt' and 'tokens.<kind>.completion'. usage can be None."""
+    def count_tokens(self, kind, usage):
+        if usage is None:
+            return
+        self.count(f"tokens.{kind}.prompt", usage.prompt_tokens)
+        self.count(f"tokens.{kind}.completion", usage.completion_tokens)
+
+    """A span for a whole turn. Spans inside it, in this thread or in threads started with contextvars.copy_context, are tagged with its id."""
+    @contextmanager
+    def turn(self, **attrs):
+        token = self.current_turn.set(next(self.turn_ids))
+        try:
+            with self.span("turn", **attrs) as span_attrs:
+                yield span_attrs
+        finally:
+            self.current_turn.reset(token)
+
+    """Also write every span to path, one json object per line."""
+    def trace_to(self, path):
+        self.trace_file = open(path, "a")
+
+    def trace(self, entry):
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.trace_file.write(line + "\n")
+            self.trace_file.flush()
+
+    """Everything aggregated so far: per span name the count, errors and p50/p95/p99/mean in ms, the counters, and a hit rate
+    for every cache that has counted 'cache.<name>.hits' and 'cache.<name>.misses'."""
+    def summary(self):
+        with self.lock:
+            durations = {name: sorted(samples) for name, samples in self.durations.items()}
+            counts = dict(self.counts)
+            errors = dict(self.errors)
+            counters = dict(self.counters)
+        spans = {}
+        for name, samples in durations.items():
+            spans[name] = {
+                "count": counts[name],
+                "errors": errors[name],
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "mean_ms": sum(samples) / len(samples) * 1000,
+            }
+        caches = {}
+        for name in counters:
+            if name.startswith("cache."):
+                cache_name = name[len("cache."):].rsplit(".", 1)[0]
+                hits = counters.get(f"cache.{cache_name}.hits", 0)
+                misses = counters.get(f"cache.{cache_name}.misses", 0)
+                caches[cache_name] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else None}
+        return {"spans": spans, "counters": counters, "caches": caches}
+
+"""Nearest-rank percentile of already sorted samples."""
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, math.ceil(p / 100 * len(samples)) - 1))]
+
+"""Wraps an API client so every method call on it is a span called '<prefix>.<method>'. Anything that isn't a method passes through."""
+class Traced:
+    def __init__(self, client, prefix, metrics=None):
+        self.client = client
+        self.prefix = prefix
+        self.metrics = metrics or default
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+
+        def traced(*args, **kwargs):
+            with self.metrics.span(f"{self.prefix}.{name}"):
+                return attr(*args, **kwargs)
+        return traced
+
+# the app's metrics, served on /metrics
+default = Metrics()
+
+span = default.span
+record = default.record
+count = default.count
+count_tokens = default.count_tokens
+turn = default.turn
+trace_to = default.trace_to
+summary = default.summary
@@ -0,0 +1,474 @@
+import json
+import random
+import string
+import threading
+import time
+import itertools
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import unquote
+from spotipy.exceptions import SpotifyException
+import songdb
+
+"""
+Local stand-ins for Spotify, OpenAI and Wikipedia, so the app can be run and benchmarked without credentials or a network.
+Every call goes through a shared CallLog, which sleeps for the configured latency and counts calls and time per endpoint.
+    FakeSpotify     the parts of spotipy.Spotify the app uses, over a generated catalog and library
+    FakeOpenAI      assistants, threads and streamed runs that replay scripted tool calls, plus chat completions
+    FakeWikipedia   a requests.Session for WikiCache that answers MediaWiki API queries from generated pages
+    FakeOEmbed      a requests.Session for EmbedCache that answers oEmbed requests
+"""
+
+"""Counts calls and the time spent in them per endpoint, after sleeping for that endpoint's latency.
+latency maps endpoint names ('spotify.search') or whole upstreams ('spotify') to seconds, the most specific match wins."""
+class CallLog:
+    def __init__(self, latency=None, default=0.0):
+        self.latency = latency or {}
+        self.default = default
+        self.lock = threading.Lock()
+        self.reset()
+
+    def delay(self, name):
+        if name in self.latency:
+            return self.latency[name]
+        return self.latency.get(name.split(".")[0], self.default)
+
+    """Record a call to name, sleeping for its latency plus extra seconds (like time spent streaming tokens)."""
+    def call(self, name, extra=0.0):
+        delay = self.delay(name) + extra
+        if delay > 0:
+            time.sleep(delay)
+        self.record(name, delay)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.counts[name] += 1
+            self.seconds[name] += seconds
+
+    def reset(self):
+        with self.lock:
+            self.counts = Counter()
+            self.seconds = Counter()
+
+    """{name: (calls, seconds)} since the last reset."""
+    def stats(self):
+        with self.lock:
+            return {name: (self.counts[name], self.seconds[name]) for name in self.counts}
+
+def random_id(rng):
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+def spotify_id(value):
+    # accepts ids, uris and open.spotify.com urls
+    return value.split("/")[-1].split(":")[-1].split("?")[0]
+
+"""A spotipy.Spotify over a generated catalog of catalog_size tracks, library_size of which are saved by the user.
+About 20 tracks per artist and 10 per album, like a real library. The user also has n_playlists playlists of playlist_size tracks,
+which partly overlap the saved tracks, and top and recently played tracks. Everything is generated from seed, so runs are repeatable."""
+class FakeSpotify:
+    def __init__(self, log, library_size=1000, catalog_size=None, seed=0, playing=True, n_playlists=5, playlist_size=150):
+        self.log = log
+        rng = random.Random(seed)
+        catalog_size = catalog_size or library_size * 2
+        self.artists = []
+        for i in range(max(catalog_size // 20, 1)):
+            artist_id = random_id(rng)
+            self.artists.append({
+                "id": artist_id,
+                "name": f"Artist {i}",
+                "uri": "spotify:artist:" + artist_id,
+                "external_urls": {"spotify": "https://open.spotify.com/artist/" + artist_id},
+                "genres": rng.sample(["rock", "pop", "jazz", "folk", "techno", "hip hop", "ambient", "soul"], 2),
+                "popularity": rng.randint(0, 100),
+                "images": [],
+            })
+        self.albums = []
+        for i in range(max(catalog_size // 10, 1)):
+            album_id = random_id(rng)
+            artist = self.artists[i % len(self.artists)]
+            self.albums.append({
+                "id": album_id,
+                "name": f"Album {i}",
+                "uri": "spotify:album:" + album_id,
+                "external_urls": {"spotify": "https://open.spotify.com/album/" + album_id},
+                "release_date": f"{rng.randint(1960, 2024)}-01-01",
+                "artists": [{key: artist[key] for key in ("id", "name", "uri", "external_urls")}],
+            })
+        self.tracks_by_id = {}
+        self.album_tracks_by_id = {album['id']: [] for album in self.albums}
+        catalog = []
+        for i in range(catalog_size):
+            track_id = random_id(rng)
+            album = self.albums[i % len(self.albums)]
+            track = {
+                "id": track_id,
+                "name": f"Track {i}",
+                "uri": "spotify:track:" + track_id,
+                "external_urls": {"spotify": "https://open.spotify.com/track/" + track_id},
+                "artists": album['artists'],
+                "album": album,
+                "duration_ms": rng.randint(90000, 400000),
+                "popularity": rng.randint(0, 100),
+            }
+            catalog.append(track)
+            self.tracks_by_id[track_id] = track
+            self.album_tracks_by_id[album['id']].append(track)
+        self.catalog = catalog
+        self.artists_by_id = {artist['id']: artist for artist in self.artists}
+        self.albums_by_id = {album['id']: album for album in self.albums}
+        # saved tracks come back newest first
+        self.library = [{"added_at": f"2024-01-01T00:00:{i % 60:02d}Z", "track": track} for i, track in enumerate(rng.sample(catalog, library_size))]
+        self.playlists = []
+        for i in range(n_playlists):
+            playlist_id = random_id(rng)
+            tracks = rng.sample(catalog, min(playlist_size, len(catalog)))
+            self.playlists.append({"id": playlist_id, "name": f"Playlist {i}", "uri": "spotify:playlist:" + playlist_id,
+                                   "tracks": {"total": len(tracks)}, "items": [{"added_at": "2024-01-01T00:00:00Z", "track": track} for track in tracks]})
+        self.playlists_by_id = {playlist['id']: playlist for playlist in self.playlists}
+        self.top = {time_range: rng.sample(catalog, min(50, len(catalog))) for time_range in ("short_term", "medium_term", "long_term")}
+        self.recent = rng.sample(catalog, min(50, len(catalog)))
+        self.playing = catalog[0] if playing else None
+        self.queue = []
+
+    def track(self, track_id, market=None):
+        self.log.call("spotify.track")
+        track = self.tracks_by_id.get(spotify_id(track_id))
+        if track is None:
+            raise SpotifyException(400, -1, "invalid id")
+        return track
+
+    def tracks(self, tracks, market=None):
+        self.log.call("spotify.tracks")
+        return {"tracks": [self.tracks_by_id.get(spotify_id(track_id)) for track_id in tracks]}
+
+    def audio_features(self, tracks=[]):
+        self.log.call("spotify.audio_features")
+        return [self.features(spotify_id(track_id)) for track_id in tracks]
+
+    """Made up but stable audio features, roughly in the ranges Spotify's fall in."""
+    def features(self, track_id):
+        if track_id not in self.tracks_by_id:
+            return None
+        rng = random.Random(track_id)
+        features = {column: rng.random() for column in songdb.FEATURE_COLUMNS}
+        features.update({
+            "key": rng.randint(-1, 11),
+            "mode": rng.randint(0, 1),
+            "loudness": rng.uniform(-20, 0),
+            "tempo": rng.uniform(60, 200),
+            "duration_ms": self.tracks_by_id[track_id]['duration_ms'],
+            "time_signature": rng.choice([3, 4, 4, 4, 5]),
+            "id": track_id,
+            "uri": "spotify:track:" + track_id,
+            "type": "audio_features",
+        })
+        return features
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        self.log.call("spotify.search")
+        items = {'track': self.catalog, 'album': self.albums, 'artist': self.artists}[type]
+        query = q.lower()
+        # exact names first, then the longest names the query contains, then the shortest names containing the query
+        ranked = []
+        for item in items:
+            name = item['name'].lower()
+            rank = 0 if name == query else 1 if name in query else 2 if query in name else None
+            if rank is not None:
+                ranked.append((rank, -len(name) if rank == 1 else len(name), item))
+        ranked.sort(key=lambda entry: entry[:2])
+        found = [item for _, _, item in ranked]
+        return {type + "s": {"total": len(found), "items": found[offset:offset + limit]}}
+
+    def album(self, album_id, market=None):
+        self.log.call("spotify.album")
+        return self.albums_by_id[spotify_id(album_id)]
+
+    def album_tracks(self, album_id, limit=50, offset=0, market=None):
+        self.log.call("spotify.album_tracks")
+        return {"items": self.album_tracks_by_id[spotify_id(album_id)][offset:offset + limit]}
+
+    def artist(self, artist_id):
+        self.log.call("spotify.artist")
+        return self.artists_by_id[spotify_id(artist_id)]
+
+    def artist_top_tracks(self, artist_id, country='US'):
+        self.log.call("spotify.artist_top_tracks")
+        artist_id = spotify_id(artist_id)
+        return {"tracks": [track for track in self.catalog if track['artists'][0]['id'] == artist_id][:10]}
+
+    def recommendations(self, seed_artists=None, seed_genres=None, seed_tracks=None, limit=20, country=None, **kwargs):
+        self.log.call("spotify.recommendations")
+        seeds = (seed_artists or []) + (seed_genres or []) + (seed_tracks or [])
+        rng = random.Random(",".join(seeds))
+        return {"tracks": rng.sample(self.catalog, min(limit, len(self.catalog))), "seeds": []}
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        self.log.call("spotify.current_user_saved_tracks")
+        return {"items": self.library[offset:offset + limit], "total": len(self.library), "limit": limit, "offset": offset}
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self.log.call("spotify.current_user_playlists")
+        items = [{key: playlist[key] for key in ("id", "name", "uri", "tracks")} for playlist in self.playlists[offset:offset + limit]]
+        return {"items": items, "total": len(self.playlists), "limit": limit, "offset": offset}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None, additional_types=("track", "episode")):
+        self.log.call("spotify.playlist_items")
+        items = self.playlists_by_id[spotify_id(playlist_id)]['items']
+        return {"items": items[offset:offset + limit], "total": len(items), "limit": limit, "offset": offset}
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range="medium_term"):
+        self.log.call("spotify.current_user_top_tracks")
+        return {"items": self.top[time_range][offset:offset + limit], "total": len(self.top[time_range])}
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self.log.call("spotify.current_user_recently_played")
+        return {"items": [{"track": track, "played_at": "2024-01-01T00:00:00Z"} for track in self.recent[:limit]]}
+
+    def current_playback(self, market=None, additional_types=None):
+        self.log.call("spotify.current_playback")
+        if self.playing is None:
+            return None
+        return {"item": self.playing, "is_playing": True}
+
+    def start_playback(self, device_id=None, context_uri=None, uris=None, offset=None, position_ms=None):
+        self.log.call("spotify.start_playback")
+        self.playing = self.tracks_by_id.get(spotify_id(uris[0])) if uris else self.playing
+
+    def add_to_queue(self, uri, device_id=None):
+        self.log.call("spotify.add_to_queue")
+        self.queue.append(uri)
+
+    def next_track(self, device_id=None):
+        self.log.call("spotify.next_track")
+        if self.queue:
+            self.playing = self.tracks_by_id.get(spotify_id(self.queue.pop(0)))
+
+    def current_user(self):
+        self.log.call("spotify.current_user")
+        return {"id": "mock", "display_name": "Mock User"}
+
+"""A requests.Session for embeds.EmbedCache that answers oEmbed requests with an iframe like Spotify's."""
+class FakeOEmbed:
+    def __init__(self, log):
+        self.log = log
+        self.headers = {}
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, **kwargs):
+        self.log.call("oembed")
+        kind, item_id = unquote(url.split("url=")[1]).split("/")[-2:]
+        return FakeResponse({"html": f'<iframe src="https://open.spotify.com/embed/{kind}/{item_id}" width="100%" height="152" frameborder="0"></iframe>'})
+
+"""Scripted assistant runs, one per prompt. A script is a list of steps, each either a list of (tool name, arguments) calls
+the assistant asks for together, or the reply text that ends the run. Prompts past the end of the scripts just get a reply.
+Runs, tool output submissions and chat completions each cost their endpoint's latency, plus 'openai.token' seconds per streamed token."""
+class FakeOpenAI:
+    def __init__(self, log, scripts=None, reply_words=60):
+        self.log = log
+        self.scripts = list(scripts or [])
+        self.reply_words = reply_words
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        # runs waiting for tool outputs: run id -> remaining steps
+        self.runs = {}
+        # every set of tool outputs submitted, for checking what the tools said
+        self.tool_outputs = []
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(create=self.create_assistant, retrieve=self.retrieve_assistant, update=self.update_assistant),
+            threads=SimpleNamespace(
+                create=self.create_thread,
+                messages=SimpleNamespace(create=self.create_message),
+                runs=SimpleNamespace(stream=self.stream_run, submit_tool_outputs_stream=self.submit_tool_outputs_stream),
+            ),
+        )
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_completion))
+
+    def next_id(self, prefix):
+        with self.lock:
+            return f"{prefix}_{next(self.ids)}"
+
+    """Queue a script for a later prompt."""
+    def add_script(self, steps):
+        self.scripts.append(steps)
+
+    def create_assistant(self, **config):
+        self.log.call("openai.assistants")
+        return SimpleNamespace(id=self.next_id("asst"), **config)
+
+    def retrieve_assistant(self, assistant_id):
+        self.log.call("openai.assistants")
+        return SimpleNamespace(id=assistant_id)
+
+    def update_assistant(self, assistant_id, **config):
+        self.log.call("openai.assistants")
+        return SimpleNamespace(id=assistant_id, **config)
+
+    def create_thread(self, messages=None):
+        self.log.call("openai.threads")
+        return SimpleNamespace(id=self.next_id("thread"))
+
+    def create_message(self, thread_id, role, content):
+        self.log.call("openai.messages")
+        return SimpleNamespace(id=self.next_id("msg"), role=role, content=content)
+
+    def stream_run(self, thread_id, assistant_id, **kwargs):
+        with self.lock:
+            steps = self.scripts.pop(0) if self.scripts else ["Sure, here you go."]
+        return FakeRunStream(self, "openai.runs", self.next_id("run"), list(steps))
+
+    def submit_tool_outputs_stream(self, thread_id, run_id, tool_outputs):
+        with self.lock:
+            self.tool_outputs.append(tool_outputs)
+            steps = self.runs.pop(run_id)
+        return FakeRunStream(self, "openai.submit_tool_outputs", run_id, steps)
+
+    """Made up reply text of reply_words words."""
+    def reply(self, messages):
+        words = ("mock reply about " + str(messages[-1]['content'])[:40]).split()
+        return " ".join(itertools.islice(itertools.cycle(words), self.reply_words))
+
+    def create_completion(self, model, messages, stream=False, stream_options=None, **kwargs):
+        text = self.reply(messages)
+        words = text.split(" ")
+        usage = SimpleNamespace(prompt_tokens=sum(len(str(message['content'])) for message in messages) // 4, completion_tokens=len(words), total_tokens=0)
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        if not stream:
+            self.log.call("openai.chat.completions", self.log.delay("openai.token") * len(words))
+            message = SimpleNamespace(role="assistant", content=text)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=usage, model=model)
+        return self.stream_completion(words, usage if (stream_options or {}).get("include_usage") else None)
+
+    """Streamed chunks of the reply. With usage, a last chunk without choices carries it, like the API with include_usage."""
+    def stream_completion(self, words, usage=None):
+        busy = self.log.delay("openai.chat.completions") + self.log.delay("openai.token") * len(words)
+        self.log.record("openai.chat.completions", busy)
+        time.sleep(self.log.delay("openai.chat.completions"))
+        for i, word in enumerate(words):
+            time.sleep(self.log.delay("openai.token"))
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word if i == 0 else " " + word))], usage=None)
+        if usage is not None:
+            yield SimpleNamespace(choices=[], usage=usage)
+
+"""One streamed stretch of a run, used like the SDK's stream: `with stream as events: for event in events`.
+Plays steps until the assistant asks for tools (the run then waits for submit_tool_outputs_stream) or replies."""
+class FakeRunStream:
+    def __init__(self, openai, name, run_id, steps):
+        self.openai = openai
+        self.name = name
+        self.run_id = run_id
+        self.steps = steps
+
+    def __enter__(self):
+        return self.events()
+
+    def __exit__(self, *exc):
+        return False
+
+    def events(self):
+        log = self.openai.log
+        # only the simulated time is logged, not the time the caller spends between events (running tools, for one)
+        busy = log.delay(self.name)
+        time.sleep(busy)
+        step = self.steps.pop(0) if self.steps else "Done."
+        if isinstance(step, str):
+            text = ""
+            for i, word in enumerate(step.split(" ")):
+                time.sleep(log.delay("openai.token"))
+                busy += log.delay("openai.token")
+                piece = word if i == 0 else " " + word
+                text += piece
+                yield event("thread.message.delta", delta=SimpleNamespace(content=[text_block(piece)]))
+            log.record(self.name, busy)
+            yield event("thread.message.completed", content=[text_block(text)])
+            # about what the instructions and tool definitions alone come to
+            usage = SimpleNamespace(prompt_tokens=1500, completion_tokens=len(text.split(" ")), total_tokens=0)
+            usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+            yield event("thread.run.completed", id=self.run_id, usage=usage)
+        else:
+            tool_calls = []
+            for name, args in step:
+                function = SimpleNamespace(name=name, arguments=json.dumps(args))
+                tool_calls.append(SimpleNamespace(id=self.openai.next_id("call"), type="function", function=function))
+            with self.openai.lock:
+                self.openai.runs[self.run_id] = self.steps
+            action = SimpleNamespace(type="submit_tool_outputs", submit_tool_outputs=SimpleNamespace(tool_calls=tool_calls))
+            log.record(self.name, busy)
+            yield event("thread.run.requires_action", id=self.run_id, required_action=action)
+
+def event(name, **data):
+    return SimpleNamespace(event=name, data=SimpleNamespace(**data))
+
+def text_block(value):
+    return SimpleNamespace(type="text", text=SimpleNamespace(value=value))
+
+"""The response to a FakeWikipedia request."""
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+"""A requests.Session for WikiCache that answers the MediaWiki queries it makes from pages, a dict of title -> plain page text.
+Each page links to links_per_page others. Use from_catalog for a page per artist and album of a FakeSpotify."""
+class FakeWikipedia:
+    def __init__(self, log, pages, links_per_page=100, seed=0):
+        self.log = log
+        self.headers = {}
+        self.pages = pages
+        self.revisions = {title: 1000 + i for i, title in enumerate(pages)}
+        rng = random.Random(seed)
+        titles = list(pages)
+        # a few links no one should follow, like real pages have
+        junk = ["1999", "March 3", "List of rock bands", "ISBN (identifier)"]
+        self.links = {title: rng.sample(titles, min(links_per_page, len(titles))) + junk for title in titles}
+
+    """Pages for every artist (as '<name> (musician)') and album of a FakeSpotify, with a lead, a few sections and links between them."""
+    @classmethod
+    def from_catalog(cls, log, spotify, paragraphs=30, seed=0):
+        rng = random.Random(seed)
+        words = "music sound record tour band studio single chart critics release guitar vocals producer label fans style influence".split()
+        filler = lambda n: " ".join(rng.choice(words) for _ in range(n)) + "."
+        pages = {}
+        for artist in spotify.artists:
+            albums = [album['name'] for album in spotify.albums if album['artists'][0]['id'] == artist['id']]
+            sections = [f"{artist['name']} is a musician known for {', '.join(artist['genres'])}. {filler(60)}"]
+            for i in range(paragraphs):
+                if i % 5 == 0:
+                    sections.append(f"\n\n== {['Career', 'Style', 'Discography', 'Legacy', 'Personal life', 'Awards'][i // 5 % 6]} ==\n")
+                sections.append(f"{filler(80)} {rng.choice(albums) if albums else ''} {filler(20)}\n")
+            pages[artist['name'] + " (musician)"] = "".join(sections)
+        for album in spotify.albums:
+            pages[album['name'] + " (album)"] = f"{album['name']} is an album by {album['artists'][0]['name']}. {filler(80)}\n\n== Reception ==\n{filler(120)}\n"
+        return cls(log, pages, seed=seed)
+
+    def get(self, url, params=None, **kwargs):
+        titles = [title.replace("_", " ") for title in params['titles'].split("|")]
+        normalized = [{"from": original, "to": title} for original, title in zip(params['titles'].split("|"), titles) if original != title]
+        prop = params['prop']
+        if prop == "links":
+            self.log.call("wikipedia.links")
+            pages = [{"title": title, "links": [{"ns": 0, "title": link} for link in self.links.get(title, [])]} for title in titles]
+        elif prop == "info":
+            self.log.call("wikipedia.info")
+            pages = [self.info(title) for title in titles]
+        elif params.get('exintro'):
+            self.log.call("wikipedia.summaries")
+            pages = [self.info(title, self.pages.get(title, "").split("\n\n==")[0]) for title in titles]
+        else:
+            self.log.call("wikipedia.extracts")
+            pages = [self.info(title, self.pages.get(title)) for title in titles]
+        return FakeResponse({"query": {"normalized": normalized, "pages": pages}})
+
+    def info(self, title, extract=None):
+        if title not in self.pages:
+            return {"title": title, "missing": True}
+        page = {"title": title, "lastrevid": self.revisions[title], "fullurl": "https://en.wikipedia.org/wiki/" + title.replace(" ", "_")}
+        if extract is not None:
+            page['extract'] = extract
+        return page
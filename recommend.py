@@ -0,0 +1,66 @@
+import numpy as np
+import songdb
+
+"""
+Content based recommendations over the songdb index, all local.
+The seed tracks' vectors are summed up as one or more taste centroids (k-means clusters, so a library that's half jazz and
+half techno doesn't average out to neither). The nearest tracks to each centroid are the candidates, which are then picked
+greedily with maximal marginal relevance, trading closeness to the taste against similarity to what's already been picked,
+and with a cap on tracks per artist.
+"""
+
+"""k-means on unit rows, seeded with k-means++. Returns (centroids, cluster sizes), dropping clusters that end up empty."""
+def kmeans(vectors, k, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = [vectors[rng.integers(len(vectors))]]
+    for _ in range(1, k):
+        distances = ((vectors[:, None, :] - np.array(centroids)[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        if distances.sum() == 0:
+            # fewer distinct tracks than clusters
+            break
+        centroids.append(vectors[rng.choice(len(vectors), p=distances / distances.sum())])
+    centroids = np.array(centroids)
+    for _ in range(iterations):
+        labels = ((vectors[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        updated = np.array([vectors[labels == j].mean(axis=0) if (labels == j).any() else centroids[j] for j in range(len(centroids))])
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    sizes = np.bincount(labels, minlength=len(centroids))
+    return centroids[sizes > 0], sizes[sizes > 0]
+
+"""Unit length taste centroids for a set of track vectors, with the share of tracks behind each. One cluster is the plain mean."""
+def taste_centroids(vectors, n_clusters=1, seed=0):
+    vectors = songdb.unit_rows(vectors)
+    if n_clusters <= 1 or len(vectors) <= 1:
+        centroids, sizes = vectors.mean(axis=0, keepdims=True), np.array([len(vectors)])
+    else:
+        centroids, sizes = kmeans(vectors, min(n_clusters, len(vectors)), seed=seed)
+    return songdb.unit_rows(centroids), sizes / sizes.sum()
+
+"""Closeness of each vector to the taste: cosine similarity to the nearest centroid."""
+def relevance(vectors, centroids):
+    return (songdb.unit_rows(vectors) @ centroids.T).max(axis=1)
+
+"""Pick up to n rows by maximal marginal relevance. Each pick maximizes (1 - diversity) * relevance - diversity * (similarity to the
+closest row already picked). With groups (say, an artist per row), at most max_per_group rows of a group are picked.
+Returns row indexes in pick order, which may be fewer than n if the caps leave nothing else."""
+def mmr(vectors, relevance, n, diversity=0.3, groups=None, max_per_group=1):
+    vectors = songdb.unit_rows(vectors)
+    available = np.ones(len(vectors), dtype=bool)
+    closest = np.zeros(len(vectors), dtype=np.float32)
+    group_counts = {}
+    picked = []
+    while len(picked) < n and available.any():
+        scores = (1 - diversity) * relevance - diversity * closest
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        closest = np.maximum(closest, vectors @ vectors[best])
+        if groups is not None:
+            group = groups[best]
+            group_counts[group] = group_counts.get(group, 0) + 1
+            if group_counts[group] >= max_per_group:
+                available &= np.array([other != group for other in groups])
+    return picked
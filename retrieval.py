@@ -0,0 +1,107 @@
+import math
+import re
+from collections import Counter
+import cache
+
+"""
+Picks the parts of a Wikipedia page that matter for a question, so prompts get a few relevant chunks instead of the whole page.
+Chunks are ranked with BM25, all local. Chunk indexes are kept per page revision, so follow-up questions about the same page reuse them.
+"""
+
+WORD = re.compile(r"\w+")
+HEADING = re.compile(r"\n\n(=+) (.+?) =+\n")
+
+# common words carry no signal for ranking
+STOPWORDS = set("a an and are as at be by for from has have he her his in is it its of on or she that the their they this to was were what when where which who why with".split())
+
+"""Rough token count, close enough for budgeting without a tokenizer."""
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+def tokenize(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+"""Split plain page text into chunks of about max_words, never crossing a section boundary. Each chunk starts with its section name."""
+def split_chunks(text, max_words=150):
+    # HEADING.split gives [lead, level, heading, body, level, heading, body, ...]
+    parts = HEADING.split(text)
+    sections = [("", parts[0])] + [(parts[i + 1], parts[i + 2]) for i in range(1, len(parts) - 2, 3)]
+    chunks = []
+    for heading, body in sections:
+        current = []
+        words = 0
+        for paragraph in body.split("\n"):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            n = len(paragraph.split())
+            if current and words + n > max_words:
+                chunks.append(format_chunk(heading, current))
+                current = []
+                words = 0
+            current.append(paragraph)
+            words += n
+        if current:
+            chunks.append(format_chunk(heading, current))
+    return chunks
+
+def format_chunk(heading, paragraphs):
+    text = "\n".join(paragraphs)
+    return f"[{heading}] {text}" if heading else text
+
+"""Okapi BM25 over a page's chunks."""
+class BM25Index:
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.terms = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(terms.values()) for terms in self.terms]
+        self.avg_length = sum(self.lengths) / max(len(self.lengths), 1)
+        doc_freqs = Counter(term for terms in self.terms for term in terms)
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    def scores(self, query):
+        query_terms = tokenize(query)
+        scores = []
+        for terms, length in zip(self.terms, self.lengths):
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.avg_length))
+            scores.append(score)
+        return scores
+
+    """Chunks that fit in token_budget, best first by score. Without a query (or a query nothing matches), the page is taken from the top.
+    The chosen chunks come back in page order so the text still reads naturally."""
+    def select(self, query, token_budget, top_k=8):
+        scores = self.scores(query) if query else [0.0] * len(self.chunks)
+        order = sorted(range(len(self.chunks)), key=lambda i: (-scores[i], i))
+        chosen = []
+        used = 0
+        for i in order:
+            if len(chosen) >= top_k:
+                break
+            tokens = count_tokens(self.chunks[i])
+            if used + tokens > token_budget:
+                continue
+            chosen.append(i)
+            used += tokens
+        if not chosen and order:
+            # even the best chunk is over budget on its own, so send as much of it as fits
+            return [self.chunks[order[0]][:token_budget * 4]]
+        return [self.chunks[i] for i in sorted(chosen)]
+
+# chunk indexes for recently researched pages, keyed by title and revision so an edited page gets re-indexed
+indexes = cache.LRUCache(max_entries=64)
+
+"""The parts of page most relevant to query that fit in token_budget, joined into one string for a prompt."""
+def page_context(page, query, token_budget=1500):
+    key = f"{page.title}:{page.lastrevid}"
+    index = indexes.get(key)
+    if index is cache.MISS:
+        index = BM25Index(split_chunks(page.text))
+        indexes.set(key, index)
+    return "\n\n".join(index.select(query, token_budget))
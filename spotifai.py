@@ -1,13 +1,29 @@
 import spotipy
 import json
-from urllib.parse import quote
-import wikipediaapi
 import dotenv
+import openai
 from openai import OpenAI
-import requests
+from openai.types.chat import ChatCompletionMessage
 import songdb
+import library
+import wikicache
+import retrieval
+import cache
+import librarystore
+import featurestore
+import recommend
+import embeds
+import metrics
 import os
 import random
+import numpy as np
+import hashlib
+import copy
+import itertools
+import threading
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 sys_msg = {"role": "system", "content": "You are SpoitfAI, a helpful Spotify assistant. You can be asked to recommend music, share thoughts on it, play it for the user, and more."}
 feature_meanings={
@@ -30,39 +46,96 @@ feature_meanings={
     'uri': 'The Spotify URI for the track',
     'valence': 'A measure from 0.0 to 1.0 describing the musical positiveness conveyed by a track. Tracks with high valence sound more positive (e.g. happy, cheerful, euphoric), while tracks with low valence sound more negative (e.g. sad, depressed, angry).'
 }
-wiki = wikipediaapi.Wikipedia('Spotifai (bkeefe313@gmail.com)','en')
-messages = []
+# cached pages for research, see wikicache.py. Made on first use (get_wiki_pages), so importing this doesn't create data/ wherever it's imported from.
+wiki_pages = None
+# guards making the shared caches, tools ask for them from several threads at once
+shared_lock = threading.Lock()
+
+def get_wiki_pages():
+    global wiki_pages
+    with shared_lock:
+        if wiki_pages is None:
+            wiki_pages = wikicache.WikiCache('Spotifai (bkeefe313@gmail.com)','en')
+        return wiki_pages
 
 # Load the tools we'll use for the assistant
 with open('tools.json') as f:
     tools = json.load(f)
 
+# everything that defines the assistant. If any of it changes, the stored assistant gets updated to match.
+assistant_config = {
+    "name": "SpotifAI",
+    "description": "A helpful Spotify assistant.",
+    "tools": tools,
+    "instructions": "You are SpotifAI, a helpful Spotify assistant. You can be asked to recommend music, share thoughts on it, play it for the user, and more.",
+    "model": "gpt-3.5-turbo-0125",
+}
+
+# cached spotify embeds, see embeds.py. Set embed_cache.local to build them without asking Spotify. Made on first use, like wiki_pages.
+embed_cache = None
+
+def get_embed_cache():
+    global embed_cache
+    with shared_lock:
+        if embed_cache is None:
+            embed_cache = embeds.EmbedCache()
+        return embed_cache
+
 """Gets a spotify embed in html. Good for looking pretty."""
 def get_oembed(item):
-    encoded_url = quote(item.url, safe='')
-    url = f"https://open.spotify.com/oembed?url={encoded_url}"
-    resp = requests.get(url).json()
-    return resp['html']
+    return get_embed_cache().get(item)
+
+"""Embeds for several items at once, fetched in parallel."""
+def get_oembeds(items):
+    return get_embed_cache().get_many(items)
 
 """A session of the app. Basically interfaces openai and spotipy."""
 class Spotifai:
-    def __init__ (self, sp):
+    def __init__ (self, sp, debug=False, history_window=20, wiki_context_tokens=1500, llm_cache_bytes=50_000_000, client=None):
         self.sp:spotipy.Spotify = sp
-        self.client = OpenAI(api_key=dotenv.get_key('.env', 'OPENAI_API_KEY'))
-        self.assistant = self.client.beta.assistants.create(
-            name="SpotifAI",
-            description="A helpful Spotify assistant.",
-            tools=tools,
-            instructions="You are SpotifAI, a helpful Spotify assistant. You can be asked to recommend music, share thoughts on it, play it for the user, and more.",
-            model="gpt-3.5-turbo-0125"
-        )
+        self.debug = debug
+        # pass a client to use something other than the real OpenAI API, like mocks.FakeOpenAI
+        self.client = client or OpenAI(api_key=dotenv.get_key('.env', 'OPENAI_API_KEY'))
+        self.assistant = self.get_assistant()
+        self.history_window = history_window
+        # answers to deterministic helper prompts (research, feature descriptions...), keyed by a hash of the model and messages
+        self.llm_cache = cache.TieredCache("data/llm_cache.sqlite", max_entries=256, max_bytes=llm_cache_bytes)
+        # how much of a Wikipedia page goes into a research prompt
+        self.wiki_context_tokens = wiki_context_tokens
+        self.reset_conversation()
         self.db = None
+        self.library_store = None
+        self.track_store = {}
+        self.sp_to_db_id = {}
+        self.db_to_sp_id = {}
+        # audio features for any track, served from the library store once it's open
+        self.feature_store = featurestore.FeatureStore(sp)
+        if not os.path.exists("data/library") and os.path.exists("data/user_library.json"):
+            print("Converting the json library to the binary store...")
+            librarystore.convert_json("data")
+        if os.path.exists("data/library"):
+            self.open_library_store()
         if os.path.exists("data/songdb.ann"):
             self.load_song_db()
-            with open("data/sp_to_db_id.json") as f:
-                self.sp_to_db_id = json.load(f)
-            with open("data/db_to_sp_id.json") as f:
-                self.db_to_sp_id = json.load(f)
+        self.register_tools()
+
+    """A new conversation that shares this one's clients, assistant and library, but has its own thread and history.
+    Cheap enough to make one per connected user."""
+    def new_session(self):
+        session = copy.copy(self)
+        session.reset_conversation()
+        session.register_tools()
+        return session
+
+    """Forget the conversation so far. The next prompt starts a new thread."""
+    def reset_conversation(self):
+        # one thread per session, rolled over into a fresh one with a summary every history_window turns
+        self.thread = None
+        self.thread_turns = 0
+        self.messages = []
+
+    """Map tool names to this session's methods."""
+    def register_tools(self):
         self.tool_names = {
             "get_current_track": self.get_current_track_TOOL,
             "find_track": self.find_track_TOOL,
@@ -81,61 +154,158 @@ class Spotifai:
             "describe_track_features": self.get_track_features_TOOL
         }
     
-    """Download up to 5000 of the user's saved library tracks. Store the data both in songdb (vectorized) and in json files for reference."""
-    def download_user_library(self):
-        self.db = songdb.SongDB(13)
+    """Download the user's tracks from sources (see library.SOURCES: saved tracks, playlists they own or follow, top tracks and recently played),
+    de-duplicated by id and without any cap. Store the data both in songdb (vectorized) and in the library store for reference.
+    Pages and audio features are fetched concurrently; progress(stage, done, total) is called as they arrive. Each feature batch is
+    folded into one raw feature matrix as it comes in, so only compact Tracks and a row of floats per track are held until the index is built."""
+    def download_user_library(self, progress=library.print_progress, workers=8, sources=library.SOURCES):
         print("Downloading user library...")
+        make_track = lambda data, added_at, source: Track(data, added_at=added_at, source=source)
+        ingest = library.Ingest(self.sp, make_track, sources, workers, progress)
         tracks = []
+        rows = []
+        for batch in ingest:
+            rows.append(songdb.feature_matrix([track.features for track in batch]))
+            for track in batch:
+                # the matrix has them now
+                track.features = None
+            tracks.extend(batch)
+        print(", ".join(f"{count} tracks from {source}" for source, count in ingest.counts.items()))
+        features = np.concatenate(rows) if rows else songdb.feature_matrix([])
+        self.index_library(tracks, features)
+        self.save_library(tracks, ingest.saved_total, features)
+
+    """Bring the stored library up to date without downloading it again. Only saved tracks are synced, other sources are only
+    refreshed by a full download. Only tracks saved since the last sync have their features fetched, and the index is only rebuilt
+    once at least rebuild_threshold tracks have been added or removed. Until then, new tracks aren't searchable and removed tracks
+    are filtered out of results. Falls back to a full download if there's no stored library."""
+    def sync_user_library(self, rebuild_threshold=50, progress=library.print_progress, workers=8):
+        if self.db is None or self.library_store is None:
+            return self.download_user_library(progress, workers)
+        tracks = self.load_library()
+        known_ids = set(track.id for track in tracks)
+        # libraries stored before there were other sources have no source, they're all saved tracks
+        saved_ids = set(track.id for track in tracks if track.source in (None, 'saved'))
+        new_tracks, removed_ids, total = library.sync_saved_tracks(self.sp, saved_ids, self.library_store.total, Track.from_saved_item, workers=workers, progress=progress)
+        # newly saved tracks that were already in from a playlist or the like keep their place and become saved tracks
+        saved_now = {track.id: track for track in new_tracks}
+        resaved = [track for track in tracks if track.id in saved_now]
+        for track in resaved:
+            track.source = 'saved'
+            track.added_at = saved_now[track.id].added_at
+        new_tracks = [track for track in new_tracks if track.id not in known_ids]
+        print(f"Found {len(new_tracks)} new and {len(removed_ids)} removed tracks.")
+        if len(new_tracks) == 0 and len(removed_ids) == 0:
+            # still store the new total and sources, or the next sync sees the count mismatch and goes looking again
+            if len(resaved) > 0 or total != self.library_store.total:
+                self.save_library(tracks, total)
+            return
+
+        tracks = new_tracks + [track for track in tracks if track.id not in removed_ids]
+        for track_id in removed_ids:
+            db_id = self.sp_to_db_id.pop(track_id, None)
+            self.db_to_sp_id.pop(db_id, None)
+        # the index isn't changed once built, so count what it's missing and what it still holds that's gone
+        unindexed = [track for track in tracks if track.db_id is None and track.features is not None]
+        stale = self.db.n_items() - len(self.db_to_sp_id)
+        if len(unindexed) + stale >= rebuild_threshold:
+            print("Rebuilding song index...")
+            self.index_library(tracks)
+        self.save_library(tracks, total)
+
+    """Build the songdb index from scratch. Tracks with features get consecutive db ids, the rest get None.
+    features is the tracks' raw feature matrix (see songdb.feature_matrix), made from their features if it isn't given."""
+    def index_library(self, tracks, features=None):
+        if features is None:
+            features = songdb.feature_matrix([track.features for track in tracks])
+        has_features = ~np.isnan(features).any(axis=1)
+        self.db = songdb.SongDB()
         self.sp_to_db_id = {}
         self.db_to_sp_id = {}
-        for i in range(0, 5000, 50):
-            results = self.sp.current_user_saved_tracks(limit=50, offset=i)
-            iter = 0
-            if len(results['items']) == 0:
-                break
-            for item in results['items']:
-                # set up the track
-                track = Track(item['track'], db_id=iter+i)
-                # store the track in the reference maps
-                self.sp_to_db_id[track.id] = iter+i
-                self.db_to_sp_id[iter+i] = track.id
-                print("found " + track.name)
-                tracks.append(track)
-                iter += 1
-        for i in range(0, len(tracks), 100):
-            if len(tracks) - i < 100:
-                working_tracks = [track for track in tracks[i:]]
-            else:
-                working_tracks = [track for track in tracks[i:i+100]]
-            features = self.sp.audio_features([track.id for track in working_tracks])
-            for j in range(0, len(working_tracks)):
-                working_tracks[j].set_features(features[j])
-        
-        for track in tracks:
-            if track.features is not None:
-                self.db.add_track(track)
-            
+        db_ids = []
+        for track, indexed in zip(tracks, has_features):
+            track.db_id = None
+            if not indexed:
+                continue
+            track.db_id = len(db_ids)
+            self.sp_to_db_id[track.id] = track.db_id
+            self.db_to_sp_id[track.db_id] = track.id
+            db_ids.append(track.db_id)
+        # vectors are built and normalized in one go over the whole library
+        self.db.add_matrix(db_ids, features[has_features])
         self.db.build()
+        if self.db.empty():
+            # nothing to search, and an index saved without a schema would only get rebuilt on every start
+            for path in ("data/songdb.ann", "data/songdb.ann.meta.json"):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
         self.db.save("data/songdb.ann")
 
-        with open("data/user_library.json", "w") as f:
-            data = [track.__dict__ for track in tracks]
-            json.dump(data, f)
+    """Write the library tracks, with their db ids and the saved track total, to the binary store in the data folder and switch over to it.
+    features is passed on to librarystore.write."""
+    def save_library(self, tracks, total, features=None):
+        librarystore.write("data/library", tracks, total, features)
+        self.open_library_store()
 
-        with open("data/sp_to_db_id.json", "w") as f:
-            json.dump(self.sp_to_db_id, f)
-        with open("data/db_to_sp_id.json", "w") as f:
-            json.dump(self.db_to_sp_id, f)
+    """Memory map the library store. Tracks and id lookups are read from it on demand, so similar tracks can be served without
+    asking Spotify and without loading the whole library into Python objects."""
+    def open_library_store(self):
+        self.library_store = librarystore.LibraryStore("data/library")
+        self.feature_store.library_store = self.library_store
+        self.track_store = librarystore.TrackStore(self.library_store, Track.from_dict)
+        self.sp_to_db_id = librarystore.SpToDbIdMap(self.library_store)
+        self.db_to_sp_id = librarystore.DbToSpIdMap(self.library_store)
+
+    """Read every stored library track back in."""
+    def load_library(self):
+        return [Track.from_dict(self.library_store.track_data(row)) for row in range(len(self.library_store))]
     
-    """Get the user library db if it already exists"""
+    """Get the user library db if it already exists. An index from before feature scaling is rebuilt from the stored library's features.
+    An index with no tracks in it counts as no index."""
     def load_song_db(self):
         try:
-            self.db = songdb.SongDB.load("data/songdb.ann", 13)
+            self.db = songdb.SongDB.load("data/songdb.ann")
+            if self.db.empty():
+                self.db = None
+        except ValueError as e:
+            self.db = None
+            if self.library_store is None:
+                print(f"Can't use the song index, {e} Download the library again to rebuild it.")
+                return
+            print(f"Rebuilding the song index, {e}")
+            tracks = self.load_library()
+            features = np.array(self.library_store.features)
+            self.index_library(tracks, features)
+            # the tracks' db ids changed with the new index
+            self.save_library(tracks, self.library_store.total, features)
         except:
             print("Failed to fetch songdb.")
             self.db = None
 
 
+    """Reuse the assistant from the last run if there is one, updating it if tools.json or the instructions changed since. Only creates a new one if there's nothing to reuse."""
+    def get_assistant(self):
+        config_hash = hashlib.sha256(json.dumps(assistant_config, sort_keys=True).encode()).hexdigest()
+        assistant = None
+        with metrics.span("openai.assistants"):
+            if os.path.exists("data/assistant.json"):
+                with open("data/assistant.json") as f:
+                    stored = json.load(f)
+                try:
+                    if stored['hash'] == config_hash:
+                        assistant = self.client.beta.assistants.retrieve(stored['id'])
+                    else:
+                        assistant = self.client.beta.assistants.update(stored['id'], **assistant_config)
+                except openai.NotFoundError:
+                    print("Stored assistant is gone, making a new one.")
+            if assistant is None:
+                assistant = self.client.beta.assistants.create(**assistant_config)
+        os.makedirs("data", exist_ok=True)
+        with open("data/assistant.json", "w") as f:
+            json.dump({"id": assistant.id, "hash": config_hash}, f)
+        return assistant
+
     """Below are the methods that the assistant has available as tools. There is a corresponding 'TOOL' version of each method that helps generalize interfacing with the assistant."""
 
 
@@ -153,7 +323,7 @@ class Spotifai:
             responses.append({"type": "message", "content": "You are not currently playing anything."})
             return "None"
         responses.append({"type": "message", "content": "Currently playing " + output.chat_string() + "."})
-        return json.dumps(output.__dict__)
+        return json.dumps(output.to_json())
     
     """Play a track on the user's Spotify."""
     def play_track(self, uri):
@@ -161,7 +331,7 @@ class Spotifai:
             track = self.sp.artist_top_tracks(uri)['tracks'][0]
             uri = track['uri']
         if 'album' in uri:
-            track = self.sp.album_tracks(uri)['items'][random.randint(0, len(self.sp.album_tracks(uri)['items'])-1)]
+            track = random.choice(self.sp.album_tracks(uri)['items'])
             uri = track['uri']
         if self.sp.current_playback() is None:
             self.sp.start_playback(uris=[uri])
@@ -183,7 +353,7 @@ class Spotifai:
             track = self.sp.artist_top_tracks(uri)['tracks'][0]
             uri = track['uri']
         if 'album' in uri:
-            track = self.sp.album_tracks(uri)['items'][random.randint(0, len(self.sp.album_tracks(uri)['items']))]
+            track = random.choice(self.sp.album_tracks(uri)['items'])
             uri = track['uri']
         self.sp.add_to_queue(uri)
         return uri
@@ -194,62 +364,157 @@ class Spotifai:
         return "Queued " + args['track'] + "."
     
 
-    """Get tracks with similar features to a given track, using the songdb vector data for library tracks. Does not work with tracks not in the user's library."""
-    def get_similar(self, track_id):
-        # make sure to trim off the "spotify:track:" part if it's there
-        if "spotify:track:" in track_id:
-            track_id = track_id.split(":")[2]
-        try:
-            track_db_id = self.sp_to_db_id[track_id]
-        except KeyError:
+    """Get up to n library tracks with similar features to a given track, or to a feature profile like {'energy': 0.9, 'tempo': 120, 'mode': 0}.
+    Tracks outside the user's library are searched for by their audio features, which are fetched once and cached.
+    The seed track itself is left out unless exclude_seed is False, and exclude_same_artist drops tracks by the seed's artist."""
+    def get_similar(self, track_id=None, n=5, exclude_seed=True, exclude_same_artist=False, profile=None):
+        # an empty library has nothing to compare against, not even a schema to scale a foreign track with
+        if self.db is None or self.db.empty():
             return None
-        similar = self.db.get_similar(track_db_id)
-        tracks = [self.sp.track(self.db_to_sp_id[str(db_id)]) for db_id in similar]
-        return [Track(track) for track in tracks]
+        seed = None
+        seed_db_id = None
+        if track_id is not None:
+            # make sure to trim off the "spotify:track:" part if it's there
+            if "spotify:track:" in track_id:
+                track_id = track_id.split(":")[2]
+            seed_db_id = self.sp_to_db_id.get(track_id)
+            seed = self.track_store.get(seed_db_id)
+
+        if seed_db_id is not None:
+            search = lambda k: self.db.get_similar(seed_db_id, k)
+        elif track_id is not None:
+            features = self.get_foreign_features(track_id)
+            if features is None:
+                return None
+            if exclude_same_artist:
+                seed = Track(self.sp.track(track_id))
+            search = lambda k: self.db.get_similar_by_features(features, k)
+        elif profile is not None:
+            search = lambda k: self.db.get_similar_by_profile(profile, k)
+        else:
+            return None
+
+        def keep(db_id):
+            # results can include tracks removed from the library since the index was built
+            if db_id not in self.db_to_sp_id:
+                return False
+            if exclude_seed and seed_db_id is not None and db_id == seed_db_id:
+                return False
+            if exclude_same_artist and seed is not None and db_id in self.track_store:
+                return self.track_store[db_id].artist['uri'] != seed.artist['uri']
+            return True
+
+        # filters can throw out a lot of results, so keep widening the search until there are enough
+        k = n * 2 + 1
+        while True:
+            similar = [db_id for db_id in search(k) if keep(db_id)]
+            if len(similar) >= n or k >= self.db.n_items():
+                break
+            k *= 4
+        similar = similar[:n]
+        return self.hydrate_tracks(similar)
+
+    """Audio features for a track outside the library, see featurestore.py. Fetched once and kept for good."""
+    def get_foreign_features(self, track_id):
+        return self.feature_store.get(track_id)
+
+    """Turn db ids into Tracks, from the in-memory track store where possible. Anything missing is fetched with one bulk tracks call per 50 ids."""
+    def hydrate_tracks(self, db_ids):
+        missing = [self.db_to_sp_id[db_id] for db_id in db_ids if db_id not in self.track_store]
+        fetched = {}
+        for i in range(0, len(missing), 50):
+            for track in Track.from_page(self.sp.tracks(missing[i:i+50])['tracks']):
+                track.db_id = self.sp_to_db_id.get(track.id)
+                fetched[track.id] = track
+        self.feature_store.enrich(list(fetched.values()))
+        tracks = []
+        for db_id in db_ids:
+            track = self.track_store.get(db_id) or fetched.get(self.db_to_sp_id[db_id])
+            if track is not None:
+                tracks.append(track)
+        return tracks
 
     def get_similar_TOOL(self, args, responses):
-        output = self.get_similar(args['id'])
+        try:
+            output = self.get_similar(args.get('id'), args.get('limit', 5), exclude_same_artist=args.get('exclude_same_artist', False), profile=args.get('features'))
+        except ValueError as e:
+            # the assistant asked for a feature that doesn't exist
+            responses.append({"type": "message", "content": "I couldn't search by those features."})
+            return str(e)
         if output is None:
             responses.append({"type": "message", "content": "I couldn't find any similar tracks."})
             return "None"
         responses.append({"type": "message", "content": "Here are some similar tracks."})
-        for track in output:
-            responses.append({"type": "embed", "content": get_oembed(track)})
-        return json.dumps([track.__dict__ for track in output])
+        for embed in get_oembeds(output):
+            responses.append({"type": "embed", "content": embed})
+        return json.dumps([track.to_json() for track in output])
     
-    """Returns a list of features for a given track"""
+    """Returns the audio features of a track, or a query to find one. None if there's no such track or Spotify has no features for it."""
     def get_track_features(self, query_track):
         if type(query_track) is not Track:
             track = self.find_track(query_track)
         else:
             track = query_track
-        if track.features == None:
-            track.set_features(self.sp.audio_features([track.uri]))
+        if track is None:
+            return None
+        self.feature_store.enrich([track])
         return track.features
     
     def get_track_features_TOOL(self, args, responses):
         output = self.get_track_features(args['track'])
+        if output is None:
+            responses.append({"type": "message", "content": "I couldn't find features for that track."})
+            return "None"
         feature_meanings_msg = {"role":"system","content":f'The following are the descriptions of the meanings of features of a track you are to describe: {json.dumps(feature_meanings)}'}
-        description = self.basic_prompt([sys_msg, feature_meanings_msg, {"role":"user","content":f'Give a general linguistic (avoid numbers) description of the song with the following features: {json.dumps(output)}'}]).content
-        responses.append({"type":"message","content":"From the information I have, this track could be described as: <br>" + description})
+        message = responses.open_message()
+        message.write("From the information I have, this track could be described as: ")
+        description = self.basic_prompt([sys_msg, feature_meanings_msg, {"role":"user","content":f'Give a general linguistic (avoid numbers) description of the song with the following features: {json.dumps(output)}'}], message.write).content
+        message.close("From the information I have, this track could be described as: <br>" + description)
         return json.dumps(output)
     
 
-    """Have the model generate a response to a prompt, using ChatCompletions rather than assistant API calls."""
-    def basic_prompt(self, prompt):
-        completion = self.client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=prompt,
-        )
-        return completion.choices[0].message
+    """Have the model generate a response to a prompt, using ChatCompletions rather than assistant API calls.
+    Identical prompts get the answer from last time, unless use_cache is False. Turn that off where a fresh reply matters, like chat."""
+    def basic_prompt(self, prompt, on_token=None, use_cache=True):
+        model = "gpt-3.5-turbo-0125"
+        key = hashlib.sha256(json.dumps({"model": model, "messages": prompt}, sort_keys=True).encode()).hexdigest()
+        if use_cache:
+            content = self.llm_cache.get(key)
+            if content is not cache.MISS:
+                metrics.count("cache.llm.hits")
+                if on_token is not None:
+                    on_token(content)
+                return ChatCompletionMessage(role="assistant", content=content)
+            metrics.count("cache.llm.misses")
+        with metrics.span("openai.chat.completions", model=model, stream=on_token is not None):
+            if on_token is None:
+                completion = self.client.chat.completions.create(
+                    model=model,
+                    messages=prompt,
+                )
+                content = completion.choices[0].message.content
+                metrics.count_tokens("chat", completion.usage)
+            else:
+                # stream the completion, handing each piece of text to on_token as it comes in
+                content = ""
+                # the last chunk has no choices, just the usage for the whole completion
+                for chunk in self.client.chat.completions.create(model=model, messages=prompt, stream=True, stream_options={"include_usage": True}):
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        content += chunk.choices[0].delta.content
+                        on_token(chunk.choices[0].delta.content)
+                    metrics.count_tokens("chat", getattr(chunk, 'usage', None))
+        if use_cache:
+            self.llm_cache.set(key, content)
+        return ChatCompletionMessage(role="assistant", content=content)
     
     def basic_prompt_TOOL(self, args, responses):
-        output = self.basic_prompt([sys_msg,{"role": "user", "content": args['prompt']}]).content
-        responses.append({"type": "message", "content": output})
+        message = responses.open_message()
+        output = self.basic_prompt([sys_msg,{"role": "user", "content": args['prompt']}], message.write, use_cache=False).content
+        message.close(output)
         return output
     
 
-    """Find a track on Spotify by searching with a query, or using a uri. Returns the top result."""
+    """Find a track on Spotify by searching with a query, or using a uri. Returns the top result, with its audio features."""
     def find_track(self, query):
         try:
             track = self.sp.track(track_id=query)
@@ -258,7 +523,7 @@ class Spotifai:
             if results['tracks']['total'] == 0:
                 return None
             track = results['tracks']['items'][0]
-        return Track(track)
+        return self.feature_store.enrich([Track(track)])[0]
     
     def find_track_TOOL(self, args, responses):
         output = self.find_track(args['query'])
@@ -267,7 +532,7 @@ class Spotifai:
             return "None"
         responses.append({"type": "message", "content": "Here's a track called " + output.chat_string() + "."})
         responses.append({"type": "embed", "content": get_oembed(output)})
-        return json.dumps(output.__dict__)
+        return json.dumps(output.to_json())
 
 
     """Find an album on Spotify by searching with a query. Returns the top result."""
@@ -285,7 +550,7 @@ class Spotifai:
             return "None"
         responses.append({"type": "message", "content": "Here's an album called " + output.chat_string() + "."})
         responses.append({"type": "embed", "content": get_oembed(output)})
-        return json.dumps(output.__dict__)
+        return json.dumps(output.to_json())
     
     
     """Find an artist on Spotify by searching with a query. Returns the top result."""
@@ -302,78 +567,135 @@ class Spotifai:
             responses.append({"type": "message", "content": "I couldn't find any artists matching that query."})
             return "None"
         responses.append({"type": "message", "content": "Here's an artist called " + output.name + "."})
-        return json.dumps(output.__dict__)
+        return json.dumps(output.to_json())
     
     
-    """Get a list of Spotify's recommendations based on up to 5 total seed tracks, artists, and/or genres. Returns up to 5 recommendations."""
-    def find_recommendations(self, seed_tracks, seed_artists, seed_genres, seed_albums):
+    """Recommend up to n tracks. source is 'local' for tracks from the user's library (see local_recommendations), 'remote' for Spotify's
+    recommendations, or 'both' to rank Spotify's recommendations together with the library's by the same taste.
+    Albums are seeded by their artists. Genres only mean something to Spotify, locally they're ignored."""
+    def find_recommendations(self, seed_tracks=[], seed_artists=[], seed_genres=[], seed_albums=[], n=5, source="local"):
+        seed_artists = list(seed_artists)
         for album in seed_albums:
-            if len(seed_artists) >= 5:
+            if len(seed_tracks) + len(seed_artists) + len(seed_genres) >= 5:
                 break
-            seed_artists.append(self.sp.album(album)['artists'][0].id)
-        results = self.sp.recommendations(seed_tracks=seed_tracks, seed_artists=seed_artists, seed_genres=seed_genres)
-        return results
+            seed_artists.append(self.sp.album(album)['artists'][0]['id'])
+        source = self.recommendation_source(source)
+        if source == "remote" and len(seed_tracks) + len(seed_artists) + len(seed_genres) == 0:
+            # Spotify won't recommend anything without a seed
+            return []
+        remote = []
+        if source in ("remote", "both"):
+            # ask for extra when they're being ranked, so the local ranking has something to choose from
+            results = self.sp.recommendations(seed_tracks=seed_tracks, seed_artists=seed_artists, seed_genres=seed_genres, limit=n if source == "remote" else max(n * 4, 20))
+            remote = Track.from_page(results['tracks'])
+        if source == "remote":
+            return remote[:n]
+        self.feature_store.enrich(remote)
+        return self.local_recommendations(seed_tracks, seed_artists, n, extra=[track for track in remote if track.features is not None])
+
+    """The source find_recommendations will actually use: 'remote' whenever there's no library to recommend from."""
+    def recommendation_source(self, source):
+        if self.db is None or self.db.empty():
+            return "remote"
+        return source
+
+    """Recommend up to n library tracks, without asking Spotify for anything but the features of seeds outside the library.
+    The taste comes from the seed tracks (ids or uris, in the library or not) and the library's tracks by the seed artists, or an artist's
+    top tracks if there are none. With no seeds at all, it's the whole library. The taste is split into up to n_clusters centroids,
+    the tracks nearest each centroid are the candidates, and they're ranked by MMR (see recommend.py) with at most max_per_artist per artist.
+    extra are more Tracks with features, like Spotify's own recommendations, to rank along with the library's."""
+    def local_recommendations(self, seed_tracks=[], seed_artists=[], n=5, n_clusters=3, diversity=0.3, max_per_artist=1, extra=[]):
+        seed_ids = [track_id.split(":")[-1] for track_id in seed_tracks]
+        seed_db_ids = [self.sp_to_db_id[track_id] for track_id in seed_ids if track_id in self.sp_to_db_id]
+        foreign_ids = [track_id for track_id in seed_ids if track_id not in self.sp_to_db_id]
+        for artist in seed_artists:
+            artist_id = artist.split(":")[-1]
+            rows = self.library_store.rows_where('artist_uri', "spotify:artist:" + artist_id) if self.library_store is not None else []
+            db_ids = [db_id for db_id in (int(self.library_store.db_ids[row]) for row in rows) if db_id in self.db_to_sp_id]
+            if db_ids:
+                seed_db_ids.extend(db_ids)
+            else:
+                foreign_ids.extend(track['id'] for track in self.sp.artist_top_tracks(artist_id)['tracks'][:5])
+        if not seed_tracks and not seed_artists:
+            seed_db_ids = list(self.db_to_sp_id)
+
+        seed_vectors = [self.db.get_vectors(seed_db_ids)]
+        foreign_features = [features for features in self.feature_store.get_many(foreign_ids).values() if features is not None]
+        if foreign_features:
+            seed_vectors.append(self.db.schema.vectors(foreign_features))
+        seed_vectors = np.concatenate(seed_vectors)
+        if len(seed_vectors) == 0:
+            return []
+        centroids, weights = recommend.taste_centroids(seed_vectors, n_clusters)
+
+        # a pool of candidates about 10 times the size of the answer, shared between clusters by how much of the taste they make up
+        exclude = set(seed_db_ids) if seed_tracks or seed_artists else set()
+        candidates = []
+        seen = set()
+        for centroid, weight in zip(centroids, weights):
+            for db_id in self.db.get_nns_by_vector(centroid, max(n, int(np.ceil(n * 10 * weight))) + len(exclude)):
+                if db_id not in seen and db_id not in exclude and db_id in self.db_to_sp_id:
+                    seen.add(db_id)
+                    candidates.append(db_id)
+        tracks = self.hydrate_tracks(candidates)
+        vectors = [self.db.get_vectors([track.db_id for track in tracks])]
+        known_ids = set(track.id for track in tracks) | set(seed_ids)
+        extra = [track for track in extra if track.id not in known_ids]
+        if extra:
+            vectors.append(self.db.schema.vectors([track.features for track in extra]))
+            tracks = tracks + extra
+        if not tracks:
+            return []
+        vectors = np.concatenate(vectors)
+
+        picked = recommend.mmr(vectors, recommend.relevance(vectors, centroids), n, diversity, [track.artist_uri for track in tracks], max_per_artist)
+        return [tracks[i] for i in picked]
     
     def find_recommendations_TOOL(self, args, responses):
-        try:
-            seed_tracks = args['seed_tracks']
-        except KeyError:
-            seed_tracks = []
-        try:
-            seed_artists = args['seed_artists']
-        except KeyError:
-            seed_artists = []
-        try:
-            seed_genres = args['seed_genres']
-        except KeyError:
-            seed_genres = []
-        if len(seed_tracks) + len(seed_artists) + len(seed_genres) == 0:
-            return "None"
-        if len(seed_tracks) + len(seed_artists) + len(seed_genres) > 5:
+        seed_tracks = args.get('seed_tracks', [])
+        seed_artists = args.get('seed_artists', [])
+        seed_genres = args.get('seed_genres', [])
+        seed_albums = args.get('seed_albums', [])
+        # seeds are checked against where the recommendations will really come from
+        source = self.recommendation_source(args.get('source', "local"))
+        n_seeds = len(seed_tracks) + len(seed_artists) + len(seed_genres) + len(seed_albums)
+        if source != "local" and n_seeds == 0:
+            return "Spotify needs at least one seed."
+        if source != "local" and n_seeds > 5:
             return "Too many seeds. Please limit to 5."
-        output = self.find_recommendations(seed_tracks, seed_artists, seed_genres, seed_genres)
+        output = self.find_recommendations(seed_tracks, seed_artists, seed_genres, seed_albums, args.get('limit', 5), source)
+        if len(output) == 0:
+            responses.append({"type": "message", "content": "I couldn't find anything to recommend."})
+            return "None"
         responses.append({"type": "message", "content": "Here are some recommendations."})
-        for i in range(0, min(len(output['tracks']), 5)):
-            tr = Track(output['tracks'][i])
-            responses.append({"type": "embed", "content": get_oembed(tr)})
-        return json.dumps(output)
+        for embed in get_oembeds(output):
+            responses.append({"type": "embed", "content": embed})
+        return json.dumps([track.to_json() for track in output])
     
     
     """Have the model research an album, track, or artist on Wikipedia."""
-    def research(self, type, subject, query=""):
-        name = subject.replace(" ", "_")
-        print(name)
+    def research(self, type, subject, query="", on_token=None):
+        print(subject)
         if type == "artist":
-            result = ""
             # oftentimes Wikipedia pages for artists are under the name of the artist followed by "(musician)" or "(band)"
             # try these first to avoid disambiguation pages
-            name = subject + "_(band)"
-            page = wiki.page(name)
-            if not page.exists():
-                name = subject + "_(musician)"
-                page = wiki.page(name)
-            if not page.exists():
-                name = subject
-                page = wiki.page(name)
-            if page.exists():
-                result = self.summarize_wiki(page, type, query)
+            page = get_wiki_pages().first_existing([subject + "_(band)", subject + "_(musician)", subject])
+            if page is not None:
+                result = self.summarize_wiki(page, type, query, on_token)
             else:
                 result = "I couldn't find any information about that artist."
         if type == "track":
-            name = subject + "_(song)"
-            page:wikipediaapi.WikipediaPage = wiki.page(name)
+            page = get_wiki_pages().page(subject + "_(song)")
             if page.exists():
-                result = self.summarize_wiki(page, type, query)
+                result = self.summarize_wiki(page, type, query, on_token)
             else:
-                result = "I couldn't find info on this track, but here's what I found about the artist:" + self.research("artist", self.find_track(subject).artist['name'], query)
+                result = "I couldn't find info on this track, but here's what I found about the artist:" + self.research("artist", self.find_track(subject).artist['name'], query, on_token)
         if type == "album":
-            page = wiki.page(subject + "_(album)")
-            if not page.exists():
-                page = wiki.page(subject)
-            if page.exists():
-                result = self.summarize_wiki(page, type, query)
+            page = get_wiki_pages().first_existing([subject + "_(album)", subject])
+            if page is not None:
+                result = self.summarize_wiki(page, type, query, on_token)
             else:
-                result = "I couldn't find info on this album, but here's what I found about the artist:" + self.research("album", self.find_artist(subject).name, query)
+                result = "I couldn't find info on this album, but here's what I found about the artist:" + self.research("album", self.find_artist(subject).name, query, on_token)
         return result
     
     def research_TOOL(self, args, responses):
@@ -381,16 +703,17 @@ class Spotifai:
             query = args['query']
         except KeyError:
             query = ""
-        output = self.research(args['type'], args['object'], query)
-        responses.append({"type": "message", "content": output})
+        message = responses.open_message()
+        output = self.research(args['type'], args['object'], query, message.write)
+        message.close(output)
         return output
     
 
     """Search for things on Wikipedia besides artists, albums, or tracks."""
-    def secondary_research(self, subject, query=""):
-        page = wiki.page(subject)
+    def secondary_research(self, subject, query="", on_token=None):
+        page = get_wiki_pages().page(subject)
         if page.exists():
-            result = self.summarize_wiki(page, "general subject", query)
+            result = self.summarize_wiki(page, "general subject", query, on_token)
         else:
             result = "No info found."
         return result
@@ -400,23 +723,17 @@ class Spotifai:
             query = args['query']
         except KeyError:
             query = ""
-        output = self.secondary_research(args['subject'], query)
-        responses.append({"type": "message", "content": output})
+        message = responses.open_message()
+        output = self.secondary_research(args['subject'], query, message.write)
+        message.close(output)
         return output
     
 
-    """'Scour' a Wikipedia page for links to articles that contain a query and are relevant to a type."""
-    def scour_page(self, page_name, query, type):
-        page = wiki.page(page_name)
-        if not page.exists():
-            return []
-        potential_links = []
-        for link in page.links:
-            p = wiki.page(link)
-            # only consider links that contain the query and are relevant to the type
-            if query in p.summary and type in p.summary:
-                potential_links.append(p)
-        return potential_links
+    """'Scour' a Wikipedia page for links to articles that contain a query and are relevant to a type.
+    Stops after max_pages links or time_budget seconds, whichever comes first, and returns what it found by then."""
+    def scour_page(self, page_name, query, type, max_pages=200, time_budget=10.0):
+        # only consider links that contain the query and are relevant to the type
+        return get_wiki_pages().scour(page_name, query, type, max_pages, time_budget)
     
     def scour_page_TOOL(self, args, responses):
         output = self.scour_page(args['page_name'], args['query'], args['type'])
@@ -450,16 +767,19 @@ class Spotifai:
 
     """The rest are internal functions that the assistant doesn't have direct access to."""
 
-    """Summarizes a Wikipedia page by asking the LLM to do so (chat completion, not assistant)."""
-    def summarize_wiki(self, page:wikipediaapi.WikipediaPage, type, query):
+    """Summarizes a Wikipedia page by asking the LLM to do so (chat completion, not assistant). Pass on_token to get the summary as it's written."""
+    def summarize_wiki(self, page:wikicache.CachedPage, type, query, on_token=None):
         print(page.title)
         # if the user has a specific query, find relevant info. Otherwise, summarize the page.
         if(query != ""):
-            research_msg = {"role": "system", "content": f"Here is information from Wikipedia about the {type} {page.title}: {page.text}"}
-            result = self.basic_prompt([sys_msg,research_msg,{"role": "user", "content": query}]).content
+            # only the parts of the page that matter for the query, not the whole thing
+            context = retrieval.page_context(page, query, self.wiki_context_tokens)
+            research_msg = {"role": "system", "content": f"Here is information from Wikipedia about the {type} {page.title}: {context}"}
+            result = self.basic_prompt([sys_msg,research_msg,{"role": "user", "content": query}], on_token).content
             result += "<br>" + f'Information obtained from <a target=”_blank” href="{page.fullurl}">'+ page.fullurl +"</a>. Note that this model can hallucinate information."
         else:
-            result = self.basic_prompt([sys_msg,{"role": "system", "content": "Summarize the following content. CONTENT:" + page.text}]).content
+            context = retrieval.page_context(page, "", self.wiki_context_tokens)
+            result = self.basic_prompt([sys_msg,{"role": "system", "content": "Summarize the following content. CONTENT:" + context}], on_token).content
             result +="<br>" + f'Information obtained from <a target=”_blank” href="{page.fullurl}">' + page.fullurl + "</a>"
         return result
     
@@ -472,116 +792,355 @@ class Spotifai:
         return response.lower() == "yes"
 
     
-    """Handle a user prompt. Given a message, will feed the request to the assistant and complete the assistant's designated tasks."""
-    # TODO Refactor this function, it's messy
-    def handle_prompt(self, msg):
-        responses = []
-        addendum = ""
-        messages.append({"role": "user", "content": msg})
-        # setup thread and run
-        thread = self.client.beta.threads.create(
-            messages=messages,
-        )
-        run = self.client.beta.threads.runs.create(
+    """Handle a user prompt. Given a message, will feed the request to the assistant and complete the assistant's designated tasks.
+    The run is streamed, so tool calls are handled as soon as the assistant asks for them instead of by polling.
+    Only the new message is sent, the conversation so far is already on the session's thread.
+    Each response is passed to on_response as soon as it's produced, and they're all returned at the end too."""
+    def handle_prompt(self, msg, on_response=None):
+        with metrics.turn() as turn:
+            responses = self.run_turn(msg, on_response)
+            turn['responses'] = len(responses)
+            return responses
+
+    """The turn itself, see handle_prompt. Time spent waiting on the run is recorded as 'openai.run' spans, one per stream,
+    from when the stream is opened until the assistant asks for tools or finishes, so tool time isn't counted as the model's."""
+    def run_turn(self, msg, on_response):
+        responses = ResponseStream(on_response)
+        if self.thread is None or self.thread_turns >= self.history_window:
+            self.thread = self.new_thread()
+            self.thread_turns = 0
+        thread = self.thread
+        with metrics.span("openai.messages.create"):
+            self.client.beta.threads.messages.create(
+                thread_id=thread.id,
+                role="user",
+                content=msg
+            )
+        self.thread_turns += 1
+        self.messages.append({"role": "user", "content": msg})
+        stream = self.client.beta.threads.runs.stream(
             thread_id=thread.id,
             assistant_id=self.assistant.id,
-            tools=tools
+            tools=tools,
+            # the model only sees the most recent messages, however long the thread gets
+            truncation_strategy={"type": "last_messages", "last_messages": self.history_window}
         )
-        # wait until run finishes
-        while run.status != "expired" and run.status != "completed" and run.status != "failed" and run.status != "cancelled":
-            run = self.client.beta.threads.runs.retrieve(
-                thread_id=thread.id,
-                run_id=run.id
-            )
-            run_steps = self.client.beta.threads.runs.steps.list(
-                thread_id=thread.id,
-                run_id=run.id
-            )
-            # print the step details, for debugging
-            if len(run_steps.data) > 0:
-                run_step = self.client.beta.threads.runs.steps.retrieve(
-                    thread_id=thread.id,
-                    run_id=run.id,
-                    step_id=run_steps.data[0].id
-                )
-                print(run_step.step_details)
-            # handle run actions
-            if run.status == "requires_action":
-                outputs = []
-                for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                    # tell user what's happening :D
-                    responses.append({"type": "system", "content": "Running tool: " + tool_call.function.name + " with args " + tool_call.function.arguments + "."})
-                    print(tool_call.function.name)
-                    # get the function and run it
-                    func = self.tool_names[tool_call.function.name]
-                    args = json.loads(tool_call.function.arguments)
-                    output = func(args, responses)
-                    # keep track of the outputs for assistant
-                    outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": output,
-                            })
-                # submit the outputs
-                run = self.client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread.id,
-                    run_id=run.id,
-                    tool_outputs=outputs
-                )
-        # if we didn't do anything?
-        if len(responses) == 0:
-            response = self.basic_prompt([sys_msg,{"role": "user", "content": msg}]).content 
-            responses.append({"type": "message", "content": response})
+        used_tools = False
+        finished = False
+        reply = None
+        # each stream ends when the run finishes or stops to wait for tool outputs, submitting them starts the next one
+        while stream is not None:
+            next_stream = None
+            started = time.perf_counter()
+            waited = None
+            with stream as events:
+                for event in events:
+                    if event.event == "thread.run.requires_action":
+                        waited = time.perf_counter() - started
+                        used_tools = True
+                        outputs = self.run_tools(event.data.required_action.submit_tool_outputs.tool_calls, responses)
+                        next_stream = self.client.beta.threads.runs.submit_tool_outputs_stream(
+                            thread_id=thread.id,
+                            run_id=event.data.id,
+                            tool_outputs=outputs
+                        )
+                    # when no tools ran, the assistant's own reply is the answer. With tools, their responses already said it.
+                    elif event.event == "thread.message.delta" and not used_tools:
+                        reply = reply or responses.open_message()
+                        for block in event.data.delta.content or []:
+                            if block.type == "text" and block.text.value:
+                                reply.write(block.text.value)
+                    elif event.event == "thread.message.completed" and not used_tools:
+                        reply = reply or responses.open_message()
+                        reply.close("".join(block.text.value for block in event.data.content if block.type == "text"))
+                        reply = None
+                    elif event.event == "thread.run.completed":
+                        waited = time.perf_counter() - started
+                        finished = True
+                        metrics.count_tokens("run", getattr(event.data, 'usage', None))
+                    elif event.event == "thread.run.step.completed" and self.debug:
+                        # print the step details, for debugging
+                        print(event.data.step_details)
+            if waited is None:
+                # failed, cancelled or expired
+                metrics.record("openai.run", time.perf_counter() - started, "run ended without finishing")
+            else:
+                metrics.record("openai.run", waited)
+            stream = next_stream
+        # only pay for a separate completion if the run failed, expired or somehow said nothing
+        said_something = any(response['type'] == "message" and response['content'] for response in responses)
+        if not said_something and (not finished or not used_tools):
+            message = responses.open_message()
+            response = self.basic_prompt([sys_msg,{"role": "user", "content": msg}], message.write, use_cache=False).content
+            message.close(response)
+
+        self.messages.append({"role": "assistant", "content": "<br>".join(response['content'] for response in responses if response['type'] == "message")})
+        return list(responses)
+
+    """Start a new thread for the session. If there's been conversation already, it gets summarized into the new thread's first message."""
+    def new_thread(self):
+        if len(self.messages) == 0:
+            with metrics.span("openai.threads.create"):
+                return self.client.beta.threads.create()
+        summary_msg = {"role": "system", "content": "Summarize this conversation between a user and a Spotify assistant in a short paragraph. Keep any tracks, artists and albums mentioned. CONVERSATION:" + json.dumps(self.messages)}
+        summary = self.basic_prompt([sys_msg, summary_msg], use_cache=False).content
+        # the summary stands in for the old history from here on
+        self.messages = [{"role": "assistant", "content": "Summary of our conversation so far: " + summary}]
+        with metrics.span("openai.threads.create"):
+            return self.client.beta.threads.create(messages=self.messages)
+
+    """Run the tool calls the assistant asked for and collect their outputs for submit_tool_outputs.
+    Calls run in parallel. Their outputs keep the order the assistant asked in, responses go out as the tools produce them."""
+    def run_tools(self, tool_calls, responses):
+        run = lambda tool_call: self.run_tool(tool_call, responses)
+        if len(tool_calls) == 1:
+            call_outputs = [run(tool_calls[0])]
+        else:
+            # each call runs in a copy of this thread's context, so its spans are tagged with the turn. One copy per call, a context can't be entered twice at once.
+            contexts = [contextvars.copy_context() for _ in tool_calls]
+            with ThreadPoolExecutor(max_workers=min(len(tool_calls), 8)) as pool:
+                call_outputs = list(pool.map(lambda context, tool_call: context.run(run, tool_call), contexts, tool_calls))
+        outputs = []
+        for tool_call, output in zip(tool_calls, call_outputs):
+            # keep track of the outputs for assistant
+            outputs.append({
+                        "tool_call_id": tool_call.id,
+                        "output": output,
+                    })
+        return outputs
+
+    """Run a single tool call and return its output. A failing tool reports its error to the assistant instead of taking down the rest of the run."""
+    def run_tool(self, tool_call, responses):
+        # tell user what's happening :D
+        responses.append({"type": "system", "content": "Running tool: " + tool_call.function.name + " with args " + tool_call.function.arguments + "."})
+        print(tool_call.function.name)
+        try:
+            # get the function and run it
+            with metrics.span("tool." + tool_call.function.name):
+                func = self.tool_names[tool_call.function.name]
+                args = json.loads(tool_call.function.arguments)
+                output = func(args, responses)
+        except Exception as e:
+            print(f"Tool {tool_call.function.name} failed: {e!r}")
+            responses.append({"type": "system", "content": "Tool " + tool_call.function.name + " failed."})
+            output = f"Error: {e}"
+        return output
+
+"""Collects a turn's responses, handing each one to on_response as soon as it's added so it can be shown right away.
+Safe to add to from several tools at once."""
+class ResponseStream(list):
+    # message ids have to be unique across turns and sessions, since they end up as element ids in the page
+    ids = itertools.count()
+
+    def __init__(self, on_response=None):
+        super().__init__()
+        self.on_response = on_response
+        self.lock = threading.Lock()
+
+    def append(self, response):
+        with self.lock:
+            super().append(response)
+        self.emit(response)
+
+    def emit(self, response):
+        if self.on_response is not None:
+            self.on_response(response)
 
-        return responses
+    """Start a message that gets written a piece at a time, see StreamedMessage."""
+    def open_message(self):
+        return StreamedMessage(self, next(ResponseStream.ids))
 
-"""Container for track info"""
+"""A message streamed to the user as it's generated. Sends message-start, then a message-delta per write, then message-end with
+the final content, which replaces what was streamed (it may add links or formatting). Only the final content is kept as a message response."""
+class StreamedMessage:
+    def __init__(self, responses, id):
+        self.responses = responses
+        self.id = id
+        self.responses.emit({"type": "message-start", "content": id})
+
+    def write(self, text):
+        self.responses.emit({"type": "message-delta", "content": {"id": self.id, "text": text}})
+
+    def close(self, content):
+        with self.responses.lock:
+            list.append(self.responses, {"type": "message", "content": content})
+        self.responses.emit({"type": "message-end", "content": {"id": self.id, "content": content}})
+
+"""Container for track info. Slotted, since thousands of these can be alive at once while the library is downloaded and indexed.
+Only the fields the app uses are pulled out of the API json. The uri and url are derived from the id instead of stored."""
 class Track:
-    def __init__ (self, data, db_id=None):
+    __slots__ = ('name', 'id', 'db_id', 'added_at', 'source', 'features', 'artist_name', 'artist_uri', 'album_name', 'album_uri')
+
+    def __init__ (self, data, db_id=None, added_at=None, source=None):
+        artist = data['artists'][0]
+        album = data['album']
         self.name = data['name']
         self.id = data['id']
-        self.uri = data['uri']
-        self.url = data['external_urls']['spotify']
         self.db_id = db_id
+        self.added_at = added_at
+        # which library source (see library.SOURCES) the track came from, if any
+        self.source = source
         self.features = None
-        self.artist = {"name": data['artists'][0]['name'], "uri": data['artists'][0]['uri']}
-        self.album = {"name": data['album']['name'], "uri": data['album']['uri']}
+        self.artist_name = artist['name']
+        self.artist_uri = artist['uri']
+        self.album_name = album['name']
+        self.album_uri = album['uri']
+
+    @property
+    def uri(self):
+        return "spotify:track:" + self.id
+
+    @property
+    def url(self):
+        return "https://open.spotify.com/track/" + self.id
+
+    @property
+    def artist(self):
+        return {"name": self.artist_name, "uri": self.artist_uri}
+
+    @property
+    def album(self):
+        return {"name": self.album_name, "uri": self.album_uri}
 
     def __str__(self):
-        return f"{self.name} by {self.artist['name']} from {self.album['name']} ({self.uri})"
+        return f"{self.name} by {self.artist_name} from {self.album_name} ({self.uri})"
     
     def chat_string(self):
-        return f"{self.name} by {self.artist['name']} from {self.album['name']}"
+        return f"{self.name} by {self.artist_name} from {self.album_name}"
     
     def set_features(self, features):
         self.features = features
 
+    """Everything about the track as a json-ready dict. This is what tools hand the assistant and what Track.from_dict reads back."""
+    def to_json(self):
+        track_id = self.id
+        return {
+            "name": self.name,
+            "id": track_id,
+            "uri": "spotify:track:" + track_id,
+            "url": "https://open.spotify.com/track/" + track_id,
+            "db_id": self.db_id,
+            "added_at": self.added_at,
+            "source": self.source,
+            "features": self.features,
+            "artist": {"name": self.artist_name, "uri": self.artist_uri},
+            "album": {"name": self.album_name, "uri": self.album_uri},
+        }
+
+    """Make a track from an item of the user's saved tracks."""
+    @staticmethod
+    def from_saved_item(item, db_id=None):
+        return Track(item['track'], db_id=db_id, added_at=item['added_at'], source='saved')
+
+    """Make tracks from a page of API items, either plain tracks or saved track items ({"added_at", "track"}).
+    Gaps (tracks that are gone or unavailable come back as None) are skipped."""
+    @classmethod
+    def from_page(cls, items):
+        tracks = []
+        for item in items:
+            if item is None:
+                continue
+            if 'track' in item:
+                if item['track'] is not None:
+                    tracks.append(cls(item['track'], added_at=item.get('added_at')))
+            else:
+                tracks.append(cls(item))
+        return tracks
+
+    """Rebuild a track from the dict to_json made (or the library store's track_data)."""
+    @classmethod
+    def from_dict(cls, data):
+        track = cls.__new__(cls)
+        track.name = data['name']
+        track.id = data['id']
+        track.db_id = data.get('db_id')
+        track.added_at = data.get('added_at')
+        track.source = data.get('source')
+        track.features = data.get('features')
+        track.artist_name = data['artist']['name']
+        track.artist_uri = data['artist']['uri']
+        track.album_name = data['album']['name']
+        track.album_uri = data['album']['uri']
+        return track
+
 """Container for album info"""
 class Album:
+    __slots__ = ('name', 'id', 'year', 'artist_name', 'artist_uri')
+
     def __init__ (self, album):
+        artist = album['artists'][0]
         self.name = album['name']
-        self.uri = album['uri']
-        self.url = album['external_urls']['spotify']
+        self.id = album['id']
         self.year = album['release_date']
-        self.artist = {"name": album['artists'][0]['name'], "uri": album['artists'][0]['uri']}
+        self.artist_name = artist['name']
+        self.artist_uri = artist['uri']
+
+    @property
+    def uri(self):
+        return "spotify:album:" + self.id
+
+    @property
+    def url(self):
+        return "https://open.spotify.com/album/" + self.id
+
+    @property
+    def artist(self):
+        return {"name": self.artist_name, "uri": self.artist_uri}
 
     def __str__(self):
-        return f"{self.name} by {self.artist['name']} ({self.uri})"
+        return f"{self.name} by {self.artist_name} ({self.uri})"
     
     def chat_string(self):
-        return f"{self.name} by {self.artist['name']}"
+        return f"{self.name} by {self.artist_name}"
+
+    def to_json(self):
+        return {"name": self.name, "uri": self.uri, "url": self.url, "year": self.year, "artist": self.artist}
+
+    """Make albums from a page of API items, skipping gaps."""
+    @classmethod
+    def from_page(cls, items):
+        return [cls(item) for item in items if item is not None]
     
-"""Container for artist info"""
+"""Container for artist info. Genres, popularity and images are only looked at when the artist is sent to the assistant,
+so the API json is kept and they're read from it when asked for."""
 class Artist:
+    __slots__ = ('name', 'id', 'data')
+
     def __init__ (self, artist):
         self.name = artist['name']
-        self.uri = artist['uri']
-        self.url = artist['external_urls']['spotify']
-        self.genres = artist['genres']
-        self.popularity = artist['popularity']
-        self.images = artist['images']
+        self.id = artist['id']
+        self.data = artist
+
+    @property
+    def uri(self):
+        return "spotify:artist:" + self.id
+
+    @property
+    def url(self):
+        return "https://open.spotify.com/artist/" + self.id
+
+    @property
+    def genres(self):
+        return self.data.get('genres', [])
+
+    @property
+    def popularity(self):
+        return self.data.get('popularity')
+
+    @property
+    def images(self):
+        return self.data.get('images', [])
 
     def __str__(self):
         return f"{self.name} ({self.uri})"
     
     def chat_string(self):
-        return f"{self.name}"
\ No newline at end of file
+        return f"{self.name}"
+
+    def to_json(self):
+        return {"name": self.name, "uri": self.uri, "url": self.url, "genres": self.genres, "popularity": self.popularity, "images": self.images}
+
+    """Make artists from a page of API items, skipping gaps."""
+    @classmethod
+    def from_page(cls, items):
+        return [cls(item) for item in items if item is not None]
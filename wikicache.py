@@ -0,0 +1,235 @@
+import re
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import cache
+import metrics
+
+DAY = 24 * 60 * 60
+
+# the most intro extracts Wikipedia returns per request
+SUMMARY_BATCH_SIZE = 20
+
+# link titles that are never worth fetching: lists, dates, identifiers and the like
+SKIP_LINK = re.compile(r"^(List of|Lists of|Outline of|Index of|Timeline of)|^\d{1,4}s?( BC| AD)?$|^(January|February|March|April|May|June|July|August|September|October|November|December) \d{1,2}$|\((identifier|disambiguation)\)$")
+
+"""The parts of a Wikipedia page the app uses, in the same shape as wikipediaapi.WikipediaPage."""
+class CachedPage:
+    def __init__(self, title, data):
+        self.title = data.get('title', title)
+        self.text = data.get('text', "")
+        self.fullurl = data.get('fullurl', "")
+        self.lastrevid = data.get('lastrevid')
+        self.missing = data.get('missing', False)
+        # the summary is the lead section, everything before the first heading
+        self.summary = self.text.split("\n\n==")[0].strip()
+
+    def exists(self):
+        return not self.missing
+
+"""Wikipedia pages cached on disk by title, including titles that don't exist.
+A cached page is trusted for fresh_for seconds. After that its revision id is checked (in one batched request for every stale page)
+and the text is only downloaded again if the page has actually changed. Missing titles are retried after missing_for seconds."""
+class WikiCache:
+    def __init__(self, user_agent, language='en', path="data/wiki_cache.sqlite", fresh_for=DAY, missing_for=DAY, workers=4):
+        self.api_url = f"https://{language}.wikipedia.org/w/api.php"
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        self.store = cache.DiskCache(path)
+        self.fresh_for = fresh_for
+        self.missing_for = missing_for
+        self.workers = workers
+
+    def page(self, title):
+        return self.pages([title])[0]
+
+    """Get several pages. Anything not cached is fetched concurrently, one request per title, so this takes one round trip."""
+    def pages(self, titles):
+        keys = [self.key(title) for title in titles]
+        entries = {key: self.store.get(key) for key in keys}
+        now = time.time()
+
+        to_fetch = []
+        to_check = []
+        for key, entry in entries.items():
+            if entry is cache.MISS:
+                to_fetch.append(key)
+            elif entry.get('missing'):
+                if now - entry['checked_at'] > self.missing_for:
+                    to_fetch.append(key)
+            elif now - entry['checked_at'] > self.fresh_for:
+                to_check.append(key)
+
+        # stale pages that haven't been edited since just get their timestamp bumped
+        if to_check:
+            revisions = self.revisions([entries[key]['title'] for key in to_check])
+            for key in to_check:
+                if revisions.get(entries[key]['title']) == entries[key]['lastrevid']:
+                    entries[key]['checked_at'] = now
+                    self.store.set(key, entries[key])
+                else:
+                    to_fetch.append(key)
+
+        metrics.count("cache.wiki.hits", len(entries) - len(to_fetch))
+        metrics.count("cache.wiki.misses", len(to_fetch))
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=min(len(to_fetch), self.workers)) as pool:
+                for key, entry in zip(to_fetch, pool.map(self.fetch, to_fetch)):
+                    entries[key] = entry
+                    self.store.set(key, entry)
+
+        return [CachedPage(key, entries[key]) for key in keys]
+
+    """The first of titles that exists, in order of preference, or None. All candidates are resolved at once."""
+    def first_existing(self, titles):
+        for page in self.pages(titles):
+            if page.exists():
+                return page
+        return None
+
+    """Fetch a page's info and plain text in one request."""
+    def fetch(self, title):
+        response = self.query("extracts", {
+            "action": "query",
+            "format": "json",
+            "formatversion": 2,
+            "redirects": 1,
+            "prop": "info|extracts",
+            "inprop": "url",
+            "explaintext": 1,
+            "titles": title,
+        })
+        page = response['query']['pages'][0]
+        if page.get('missing') or page.get('invalid'):
+            return {"title": title, "missing": True, "checked_at": time.time()}
+        return {
+            "title": page['title'],
+            "text": page.get('extract', ""),
+            "fullurl": page['fullurl'],
+            "lastrevid": page['lastrevid'],
+            "checked_at": time.time(),
+        }
+
+    """Latest revision ids for up to 50 titles per request."""
+    def revisions(self, titles):
+        revisions = {}
+        for i in range(0, len(titles), 50):
+            response = self.query("revisions", {
+                "action": "query",
+                "format": "json",
+                "formatversion": 2,
+                "prop": "info",
+                "titles": "|".join(titles[i:i+50]),
+            })
+            for page in response['query']['pages']:
+                if not page.get('missing'):
+                    revisions[page['title']] = page['lastrevid']
+        return revisions
+
+    """Titles of the articles a page links to, cached for fresh_for seconds."""
+    def links(self, title):
+        key = "links:" + self.key(title)
+        links = self.store.get(key)
+        if links is not cache.MISS:
+            metrics.count("cache.wiki_links.hits")
+            return links
+        metrics.count("cache.wiki_links.misses")
+        links = []
+        params = {
+            "action": "query",
+            "format": "json",
+            "formatversion": 2,
+            "redirects": 1,
+            "prop": "links",
+            "plnamespace": 0,
+            "pllimit": "max",
+            "titles": title,
+        }
+        while True:
+            response = self.query("links", params)
+            for page in response['query']['pages']:
+                links.extend(link['title'] for link in page.get('links', []))
+            if 'continue' not in response:
+                break
+            params.update(response['continue'])
+        self.store.set(key, links, self.fresh_for)
+        return links
+
+    """Lead section summaries and urls for many titles, SUMMARY_BATCH_SIZE per request. Returns {title: {"summary", "fullurl"}}, skipping missing pages."""
+    def summaries(self, titles):
+        found = {}
+        to_fetch = []
+        for title in titles:
+            entry = self.store.get("summary:" + self.key(title))
+            if entry is cache.MISS:
+                to_fetch.append(title)
+            elif entry is not None:
+                found[title] = entry
+        metrics.count("cache.wiki_summaries.hits", len(titles) - len(to_fetch))
+        metrics.count("cache.wiki_summaries.misses", len(to_fetch))
+        for i in range(0, len(to_fetch), SUMMARY_BATCH_SIZE):
+            batch = to_fetch[i:i + SUMMARY_BATCH_SIZE]
+            response = self.query("summaries", {
+                "action": "query",
+                "format": "json",
+                "formatversion": 2,
+                "prop": "info|extracts",
+                "inprop": "url",
+                "exintro": 1,
+                "explaintext": 1,
+                "exlimit": SUMMARY_BATCH_SIZE,
+                "titles": "|".join(batch),
+            })
+            pages = {page['title']: page for page in response['query']['pages']}
+            # titles come back normalized, map them back to what was asked for
+            for normalized in response['query'].get('normalized', []):
+                if normalized['to'] in pages:
+                    pages[normalized['from']] = pages[normalized['to']]
+            for title in batch:
+                page = pages.get(title)
+                entry = None
+                if page is not None and not page.get('missing') and not page.get('invalid'):
+                    entry = {"title": page['title'], "summary": page.get('extract', "").strip(), "fullurl": page.get('fullurl', "")}
+                    found[title] = entry
+                self.store.set("summary:" + self.key(title), entry, self.fresh_for if entry is not None else self.missing_for)
+        return found
+
+    """Find the pages linked from page_name whose summaries mention both query and type.
+    Link titles are filtered before anything is fetched, titles that already mention the query or type go first, and at most max_pages
+    summaries are fetched, in parallel batches. Whatever has been found when time_budget seconds run out is returned."""
+    def scour(self, page_name, query, type, max_pages=200, time_budget=10.0):
+        deadline = time.monotonic() + time_budget
+        query = query.lower()
+        type = type.lower()
+        candidates = [link for link in self.links(page_name) if not SKIP_LINK.search(link)]
+        candidates.sort(key=lambda link: -((query in link.lower()) + (type in link.lower())))
+        candidates = candidates[:max_pages]
+
+        results = []
+        batches = [candidates[i:i + SUMMARY_BATCH_SIZE] for i in range(0, len(candidates), SUMMARY_BATCH_SIZE)]
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        waiting = set(pool.submit(self.summaries, batch) for batch in batches)
+        while waiting:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"Scouring {page_name} ran out of time with {len(waiting)} batches left.")
+                break
+            done, waiting = wait(waiting, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                for entry in future.result().values():
+                    summary = entry['summary'].lower()
+                    if query in summary and type in summary:
+                        results.append(CachedPage(entry['title'], {"title": entry['title'], "text": entry['summary'], "fullurl": entry['fullurl']}))
+        # batches already running finish in the background and still land in the cache
+        pool.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    """One API request, timed as a 'wikipedia.<name>' span."""
+    def query(self, name, params):
+        with metrics.span("wikipedia." + name):
+            return self.session.get(self.api_url, params=params).json()
+
+    """Titles are cached the way Wikipedia treats them, so 'The_Beatles' and 'The Beatles' share an entry."""
+    def key(self, title):
+        title = title.replace("_", " ").strip()
+        return title[:1].upper() + title[1:]